@@ -0,0 +1,56 @@
+import datetime
+from django.db import models
+from smartmin import class_from_string
+
+from smartmin.models import SmartModel
+
+class ExportTask(SmartModel):
+    # the request META keys which are saved with an export and set on the request it is run with
+    EXPORT_META = ('HTTP_HOST', 'SERVER_NAME', 'SERVER_PORT', 'SCRIPT_NAME', 'REMOTE_ADDR', 'HTTPS', 'wsgi.url_scheme',
+                   'HTTP_USER_AGENT', 'HTTP_ACCEPT_LANGUAGE', 'HTTP_REFERER')
+
+    csv_file = models.FileField(upload_to="csv_exports", null=True, blank=True, verbose_name="Export file", help_text="The comma delimited file of exported records")
+    model_class = models.CharField(max_length=255, help_text="The model we are exporting")
+    path = models.CharField(max_length=255, help_text="The path of the view which is exporting our records, without any script prefix")
+    export_params = models.TextField(help_text="The query string of the export request")
+    export_meta = models.TextField(default="{}", help_text="The request headers and server variables the export is run with, as JSON")
+    export_log = models.TextField()
+    task_id = models.CharField(null=True, max_length=64)
+    progress = models.IntegerField(default=0, help_text="How far along our export is, as a percentage")
+
+    def start(self):
+        from .tasks import csv_export
+        self.log("Queued export at %s" % datetime.datetime.now())
+        result = csv_export.delay(self)
+        self.task_id = result.task_id
+        self.save()
+
+    def done(self):
+        from .tasks import csv_export
+        if self.task_id:
+            result = csv_export.AsyncResult(self.task_id)
+            return result.ready()
+
+    def status(self):
+        from .tasks import csv_export
+        status = "PENDING"
+        if self.task_id:
+            result = csv_export.AsyncResult(self.task_id)
+            status = result.state
+        return status
+
+    def log(self, message):
+        self.export_log += "%s\n" % message
+        self.modified_on = datetime.datetime.now()
+        self.save()
+
+    def set_progress(self, progress):
+        """
+        Updates our progress without saving the rest of our fields, so it is cheap enough to call as each
+        chunk of rows is written.
+        """
+        self.progress = progress
+        ExportTask.objects.filter(pk=self.pk).update(progress=progress, modified_on=datetime.datetime.now())
+
+    def __unicode__(self):
+        return "%s Export" % class_from_string(self.model_class)._meta.verbose_name.title()
@@ -0,0 +1,56 @@
+from celery.task import task
+from datetime import datetime
+
+@task(track_started=True)
+def csv_export(task):
+    from django.conf import settings
+    from django.contrib.auth.models import AnonymousUser
+    from django.core.urlresolvers import resolve
+    from django.http import HttpRequest, QueryDict
+    from django.utils import simplejson
+    from django.utils.datastructures import MergeDict
+
+    try:
+        task.task_id = csv_export.request.id
+        task.log("Started export at %s" % datetime.now())
+        task.log("--------------------------------")
+
+        # rebuild the request which queued us, our view sees the task on it and writes to its file.  Note
+        # that this request doesn't go through any middleware, so it has no session, and its META only has
+        # the keys in ExportTask.EXPORT_META, views which need anything more can't be exported in the background
+        request = HttpRequest()
+        request.method = 'GET'
+        request.META = simplejson.loads(task.export_meta)
+        request.META.update(REQUEST_METHOD='GET', PATH_INFO=task.path, QUERY_STRING=task.export_params)
+
+        # our path is saved without any prefix we are served under, which resolve() doesn't expect
+        request.path_info = task.path
+        request.path = request.META.get('SCRIPT_NAME', '').rstrip('/') + task.path
+        request.session = {}
+        request.GET = QueryDict(task.export_params)
+        request.POST = QueryDict('')
+        request.REQUEST = MergeDict(request.POST, request.GET)
+        request.export_task = task
+
+        if task.created_by_id == settings.ANONYMOUS_USER_ID:
+            request.user = AnonymousUser()
+        else:
+            request.user = task.created_by
+
+        match = resolve(task.path)
+        response = match.func(request, *match.args, **match.kwargs)
+
+        if response.status_code != 200:
+            raise Exception("Export view returned status %d" % response.status_code)
+
+        task.log(response.content)
+        task.log("Export finished at %s" % datetime.now())
+
+    except Exception as e:
+        import traceback
+        traceback.print_exc(e)
+
+        task.log("\nError: %s\n" % e)
+        raise e
+
+    return task
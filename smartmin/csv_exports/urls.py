@@ -0,0 +1,3 @@
+from smartmin.csv_exports.views import ExportTaskCRUDL
+
+urlpatterns = ExportTaskCRUDL().as_urlpatterns()
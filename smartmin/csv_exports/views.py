@@ -0,0 +1,33 @@
+from smartmin import class_from_string
+from smartmin.csv_exports.models import ExportTask
+from smartmin.views import SmartCRUDL, SmartListView, SmartReadView
+
+class ExportTaskCRUDL(SmartCRUDL):
+    model = ExportTask
+    actions = ('read', 'list')
+
+    class Read(SmartReadView):
+        def has_permission(self, request, *args, **kwargs):
+            """
+            Users can always check on the exports they queued
+            """
+            if super(ExportTaskCRUDL.Read, self).has_permission(request, *args, **kwargs):
+                return True
+
+            return request.user.is_authenticated() and self.get_object().created_by_id == request.user.id
+
+        def derive_refresh(self):
+            if self.object.status() in ["PENDING", "RUNNING", "STARTED"]:
+                return 2000
+            else:
+                return 0
+
+    class List(SmartListView):
+        fields = ('status', 'type', 'progress', 'csv_file', 'created_on', 'created_by')
+        link_fields = ('csv_file',)
+
+        def get_type(self, obj):
+            return class_from_string(obj.model_class)._meta.verbose_name_plural.title()
+
+        def get_progress(self, obj):
+            return "%d%%" % obj.progress
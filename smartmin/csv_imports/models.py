@@ -1,23 +1,213 @@
 import datetime
-from django.db import models, transaction
+import time
+from django.utils import simplejson
+from django.db import models, transaction, connections, DEFAULT_DB_ALIAS
+from django.db.models import F
 from smartmin import class_from_string
 
 from smartmin.models import SmartModel
 
+# the alias of the connection import progress is written on
+PROGRESS_DB_ALIAS = 'smartmin_progress'
+
+def get_progress_db():
+    """
+    Returns the alias of the database connection import progress is written on.  This is a second connection
+    to our default database, so that progress is committed as it is written rather than when the import's own
+    transaction is, and so that the task's row isn't locked for the whole import.
+
+    SQLite locks the whole database for a transaction, and in memory databases aren't shared between
+    connections, so there we write progress on the default connection and it only shows once committed.
+    """
+    settings_dict = connections.databases[DEFAULT_DB_ALIAS]
+    if settings_dict['ENGINE'].endswith('sqlite3'):
+        return DEFAULT_DB_ALIAS
+
+    if PROGRESS_DB_ALIAS not in connections.databases:
+        connections.databases[PROGRESS_DB_ALIAS] = dict(settings_dict)
+
+    return PROGRESS_DB_ALIAS
+
 class ImportTask(SmartModel):
     csv_file = models.FileField(upload_to="csv_imports", verbose_name="Import file", help_text="A comma delimited file of records to import")
     model_class = models.CharField(max_length=255, help_text="The model we are importing for")
     import_params = models.TextField(help_text="JSON blob of form parameters on task creation")
     import_log = models.TextField()
     task_id = models.CharField(null=True, max_length=64)
+    rows_processed = models.IntegerField(default=0, help_text="How many rows of our file have been imported")
+    rows_failed = models.IntegerField(default=0, help_text="How many rows of our file have failed to import")
+    bytes_read = models.BigIntegerField(default=0, help_text="How much of our file has been read, in bytes")
+    checkpoint_line = models.IntegerField(null=True, help_text="The last line of our file which has been committed")
+    checkpoint_offset = models.BigIntegerField(null=True, help_text="Where the last line which has been committed ends, in bytes")
+    failed_chunks = models.TextField(null=True, help_text="JSON list of the chunks of our file which failed to import, which are all that is retried if we are resumed")
+    validate_only = models.BooleanField(default=False, help_text="Whether to only check the file for errors rather than import it")
+    error_report = models.FileField(upload_to="csv_imports", null=True, blank=True, help_text="A comma delimited file of the errors found when validating")
+
+    # our log and progress are written at most this often, in seconds, or once this many messages are logged
+    flush_interval = 2
+    flush_messages = 100
+
+    # imports which haven't written anything in this many seconds may have died, see is_resumable()
+    stale_after = 300
+
+    # how long we wait for our workers to tell us what they are running, in seconds
+    inspect_timeout = 1.0
+
+    class Meta:
+        # needed to resume imports, see can_resume()
+        permissions = (("importtask_resume", "Can resume import task"),)
+
+    # our progress counters, chunks of our file may be imported in parallel so we only ever add to these
+    COUNTERS = ('rows_processed', 'rows_failed', 'bytes_read')
+
+    def __init__(self, *args, **kwargs):
+        super(ImportTask, self).__init__(*args, **kwargs)
+        self._flushed_counts = self.get_counts()
+        self._committed_counts = self.get_counts()
+
+    def save(self, *args, **kwargs):
+        super(ImportTask, self).save(*args, **kwargs)
+        self._flushed_counts = self.get_counts()
+
+    def get_counts(self):
+        return dict([(counter, getattr(self, counter)) for counter in ImportTask.COUNTERS])
+
+    def commit_counts(self):
+        """
+        Marks what we have counted so far as committed, called whenever the rows we have imported are
+        """
+        self._committed_counts = self.get_counts()
+
+    def rollback_counts(self):
+        """
+        Takes back everything we have counted since commit_counts() was last called, used when the rows we
+        counted have been rolled back.  If our progress is written on its own connection this is written out
+        straight away, otherwise what we flushed was rolled back along with our rows.
+        """
+        for counter in ImportTask.COUNTERS:
+            setattr(self, counter, self._committed_counts[counter])
+
+        if get_progress_db() == DEFAULT_DB_ALIAS:
+            self._flushed_counts = dict(self._committed_counts)
+        else:
+            self.flush()
+
+    def save_checkpoint(self, line_number, offset):
+        """
+        Records the last line which has been imported, and where it ends.  This is written on our import's
+        own connection so that it is committed along with the rows it covers, callers should commit straight
+        after so that our row isn't left locked.
+        """
+        self.checkpoint_line = line_number
+        self.checkpoint_offset = offset
+        ImportTask.objects.filter(pk=self.pk).update(checkpoint_line=line_number, checkpoint_offset=offset)
 
     def start(self):
         from .tasks import csv_import
         self.log("Queued import at %s" % datetime.datetime.now())
-        result = csv_import.delay(self)
-        self.task_id = result.task_id
+        self.task_id = None
         self.save()
 
+        # our import may already be writing to us, or even be done, so only set our task id if it hasn't
+        result = csv_import.delay(self)
+        ImportTask.objects.filter(pk=self.pk, task_id=None).update(task_id=result.task_id)
+        self.task_id = ImportTask.objects.filter(pk=self.pk).values_list('task_id', flat=True)[0]
+
+    def get_failed_chunks(self):
+        """
+        Returns the (start, end, line number) tuples of the chunks of our file which failed to import, the
+        rest were committed
+        """
+        if not self.failed_chunks:
+            return []
+
+        return [tuple(chunk) for chunk in simplejson.loads(self.failed_chunks)]
+
+    def is_resumable(self):
+        """
+        Whether we have a checkpoint or failed chunks to resume from and have either failed or look to have died
+        part way through.  This doesn't ask our workers, so is cheap enough to check whenever we are displayed.
+        """
+        if self.checkpoint_offset is None and not self.failed_chunks:
+            return False
+
+        status = self.status()
+        if status == "FAILURE":
+            return True
+
+        stale = self.modified_on < datetime.datetime.now() - datetime.timedelta(seconds=self.stale_after)
+        return status in ["PENDING", "RUNNING", "STARTED"] and stale
+
+    def can_resume(self):
+        """
+        Whether we can actually be resumed, see is_resumable()
+        """
+        if not self.is_resumable():
+            return False
+
+        # an import which hasn't written anything in a while may just be slow, so we also check no worker has it
+        return self.status() == "FAILURE" or self.is_running() is False
+
+    def is_running(self):
+        """
+        Whether any of our workers is running our import or has it queued, asking them rather than trusting our
+        status, which stays STARTED if the worker running us dies.  Returns None if our workers can't be asked.
+        """
+        from .tasks import csv_import
+
+        # tasks run inline are never left running
+        if csv_import.app.conf.CELERY_ALWAYS_EAGER:
+            return False
+
+        try:
+            inspect = csv_import.app.control.inspect(timeout=self.inspect_timeout)
+            workers = [inspect.active(), inspect.reserved(), inspect.scheduled()]
+        except Exception:
+            return None
+
+        for tasks in [worker_tasks for found in workers if found for worker_tasks in found.values()]:
+            for task in tasks:
+                # scheduled tasks are wrapped with when they are due
+                if task.get('request', task).get('id') == self.task_id:
+                    return True
+
+        return False
+
+    def resume(self):
+        if self.failed_chunks:
+            self.log("Retrying %d failed chunk(s)" % len(self.get_failed_chunks()))
+        else:
+            self.log("Resuming after line %d" % self.checkpoint_line)
+        self.start()
+
+    def write_error_report(self, errors, logged=10):
+        """
+        Writes the passed in (line number, error) tuples to our error report, logging the first few of them.
+        Returns how many errors there were.
+        """
+        import csv
+        import os
+        import tempfile
+        from django.core.files import File
+
+        count = 0
+        with tempfile.NamedTemporaryFile() as temp:
+            writer = csv.writer(temp, quoting=csv.QUOTE_ALL)
+            writer.writerow(["Line", "Error"])
+
+            for (line_number, error) in errors:
+                writer.writerow([line_number, unicode(error).encode("utf-8")])
+
+                if count < logged:
+                    self.log("Line %d: %s" % (line_number, error))
+                count += 1
+
+            temp.flush()
+            name = "%s_errors.csv" % os.path.splitext(os.path.basename(self.csv_file.name))[0]
+            self.error_report.save(name, File(temp), save=False)
+
+        return count
+
     def done(self):
         from .tasks import csv_import
         if self.task_id:
@@ -33,9 +223,68 @@ class ImportTask(SmartModel):
         return status
 
     def log(self, message):
+        """
+        Adds the passed in message to our log, which is buffered and written every so often rather than
+        on every message.  Call flush() to make sure everything logged has been written.
+        """
         self.import_log += "%s\n" % message
+        self._unflushed = getattr(self, '_unflushed', 0) + 1
+
+        if self._unflushed >= self.flush_messages:
+            self.flush()
+        else:
+            self.flush_if_due()
+
+    def record_progress(self, rows_processed=0, rows_failed=0, bytes_read=0):
+        """
+        Adds to our progress counters, writing them out every flush_interval seconds
+        """
+        self.rows_processed += rows_processed
+        self.rows_failed += rows_failed
+        self.bytes_read += bytes_read
+        self.flush_if_due()
+
+    def flush_if_due(self):
+        if time.time() - getattr(self, '_flushed_at', 0) >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes our log and adds to our progress counters, leaving the rest of our fields alone.  These are
+        written and committed on the connection returned by get_progress_db(), not that of our import.
+        """
         self.modified_on = datetime.datetime.now()
-        self.save()
+
+        if self.pk:
+            updates = dict(modified_on=self.modified_on)
+
+            if getattr(self, '_unflushed', 0):
+                updates['import_log'] = self.import_log
+
+            counts = self.get_counts()
+            for counter in ImportTask.COUNTERS:
+                added = counts[counter] - self._flushed_counts[counter]
+                if added:
+                    updates[counter] = F(counter) + added
+
+            ImportTask.objects.using(get_progress_db()).filter(pk=self.pk).update(**updates)
+            self._flushed_counts = counts
+        else:
+            self.save()
+
+        self._unflushed = 0
+        self._flushed_at = time.time()
+
+    def percent_read(self):
+        """
+        How much of our file has been read, as a percentage
+        """
+        try:
+            size = self.csv_file.size
+        except Exception:
+            return 0
+
+        return min(100, self.bytes_read * 100 / size) if size else 100
 
     def __unicode__(self):
         return "%s Import" % class_from_string(self.model_class)._meta.verbose_name.title()
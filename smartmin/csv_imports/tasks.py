@@ -1,5 +1,7 @@
 import StringIO
+from celery import chord
 from celery.task import task
+from celery.utils import uuid
 from datetime import datetime
 from smartmin import class_from_string
 
@@ -19,24 +21,80 @@ def csv_import(task):  #pragma: no cover
         task.save()
 
         transaction.commit()
+        task.commit_counts()
 
         model = class_from_string(task.model_class)
-        records = model.import_csv(task, log)
+
+        # we are only checking our file, nothing gets written
+        if task.validate_only:
+            errors = task.write_error_report(model.validate_csv(task))
+
+            task.log("Validation finished at %s" % datetime.now())
+            task.log("%d error(s) found." % errors)
+            task.save()
+
+            transaction.commit()
+            task.commit_counts()
+            return task
+
+        # we are resuming, pick up after the last row which was committed
+        chunk = None
+        if task.checkpoint_offset is not None:
+            chunk = (task.checkpoint_offset, None, task.checkpoint_line)
+
+        # large files are split into chunks which are imported in parallel, then merged back together.  If
+        # some chunks failed last time, the rest were committed, so we only import those again
+        retried = task.get_failed_chunks()
+        chunks = retried or (model.split_csv(task) if model.import_chunk_bytes and not chunk else None)
+        if chunks and (len(chunks) > 1 or retried):
+            merge_id = uuid()
+            merge = csv_import_merge.s(task.pk).set(task_id=merge_id)
+
+            # our status is that of our merge from here on
+            task.task_id = merge_id
+            task.failed_chunks = None
+            task.log("Importing in %d chunks" % len(chunks))
+            task.save()
+
+            transaction.commit()
+
+            # every chunk is decoded the same way, so we only scan our file for its encoding once
+            codec = model.detect_codec(task)
+            chord([csv_import_chunk.s(task.pk, chunk, codec) for chunk in chunks])(merge)
+            return task
+
+        # resumable imports are committed a batch at a time, remembering where they got to
+        checkpoint = None
+        if model.import_resumable:
+            def checkpoint(line_number, offset):
+                task.flush()
+                task.save_checkpoint(line_number, offset)
+                transaction.commit()
+                task.commit_counts()
+
+        records = model.import_csv(task, log, chunk, checkpoint)
 
         task.log(log.getvalue())
         task.log("Import finished at %s" % datetime.now())
         task.log("%d record(s) added." % len(records))
+        task.flush()
 
         transaction.commit()
+        task.commit_counts()
 
     except Exception as e:
         transaction.rollback()
 
+        # anything we counted since our last commit was rolled back, but we still count the row which failed
+        task.rollback_counts()
+        task.record_progress(rows_failed=1)
+
         import traceback
         traceback.print_exc(e)
 
         task.log("\nError: %s\n" % e)
         task.log(log.getvalue())
+        task.flush()
         transaction.commit()
 
         raise e
@@ -45,3 +103,73 @@ def csv_import(task):  #pragma: no cover
         transaction.leave_transaction_management()
 
     return task
+
+@task(track_started=True)
+def csv_import_chunk(task_pk, chunk, codec=None):
+    """
+    Imports a single chunk of a file, in its own transaction.  Errors are returned rather than raised so
+    that our merge still runs when some chunks fail.
+    """
+    from django.db import transaction
+    from .models import ImportTask
+
+    transaction.enter_transaction_management()
+    transaction.managed()
+
+    log = StringIO.StringIO()
+    task = None
+
+    try:
+        task = ImportTask.objects.get(pk=task_pk)
+        model = class_from_string(task.model_class)
+
+        records = model.import_csv(task, log, chunk, codec=codec)
+        task.flush()
+
+        transaction.commit()
+        return dict(chunk=chunk, records=len(records), error=None, log=log.getvalue())
+
+    except Exception as e:
+        transaction.rollback()
+
+        # the rows of this chunk were rolled back, but we still count the one which failed
+        if task:
+            task.rollback_counts()
+            task.record_progress(rows_failed=1)
+            task.flush()
+        transaction.commit()
+
+        return dict(chunk=chunk, records=0, error=str(e), log=log.getvalue())
+
+    finally:
+        transaction.leave_transaction_management()
+
+@task(track_started=True)
+def csv_import_merge(results, task_pk):
+    """
+    Merges the results of the chunks of an import into its log, failing if any of them failed.  Chunks which
+    failed are saved on our task, resuming it retries just those.
+    """
+    from django.utils import simplejson
+    from .models import ImportTask
+
+    task = ImportTask.objects.get(pk=task_pk)
+
+    failed = []
+    for result in sorted(results, key=lambda result: result['chunk'][0]):
+        if result['error']:
+            failed.append(result['chunk'])
+            task.log("\nError: %s\n" % result['error'])
+
+        if result['log']:
+            task.log(result['log'])
+
+    task.log("Import finished at %s" % datetime.now())
+    task.log("%d record(s) added." % sum([result['records'] for result in results]))
+    task.flush()
+
+    if failed:
+        ImportTask.objects.filter(pk=task_pk).update(failed_chunks=simplejson.dumps(failed))
+        raise Exception("%d of %d chunks failed to import" % (len(failed), len(results)))
+
+    return task
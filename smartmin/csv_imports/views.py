@@ -1,11 +1,13 @@
 # Create your views here.
+from django.core.urlresolvers import reverse
+from django.http import HttpResponseRedirect
 from smartmin import class_from_string
 from smartmin.csv_imports.models import ImportTask
 from smartmin.views import SmartCRUDL, SmartListView, SmartReadView
 
 class ImportTaskCRUDL(SmartCRUDL):
     model = ImportTask
-    actions = ('read', 'list')
+    actions = ('read', 'list', 'resume')
 
     class Read(SmartReadView):
         def derive_refresh(self):
@@ -14,6 +16,20 @@ class ImportTaskCRUDL(SmartCRUDL):
             else:
                 return 0
 
+    class Resume(SmartReadView):
+        """
+        Resumes an import which failed or died from its last checkpoint, only accepts POSTs
+        """
+        def get(self, request, *args, **kwargs):
+            return HttpResponseRedirect(reverse('csv_imports.importtask_read', args=[self.kwargs['pk']]))
+
+        def post(self, request, *args, **kwargs):
+            task = self.get_object()
+            if task.can_resume():
+                task.resume()
+
+            return HttpResponseRedirect(reverse('csv_imports.importtask_read', args=[task.pk]))
+
     class List(SmartListView):
         fields = ('status', 'type', 'csv_file', 'created_on', 'created_by')
         link_fields = ('csv_file',)
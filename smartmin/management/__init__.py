@@ -2,11 +2,12 @@ from django.db.models.signals import post_syncdb
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.auth.models import Permission, Group, User
 from django.conf import settings
-from django.core.exceptions import ObjectDoesNotExist
-from guardian.shortcuts import assign, remove_perm
+from django.db import transaction
 from guardian.utils import get_anonymous_user
 from guardian.management import create_anonymous_user
+from smartmin.perms import invalidate_permissions
 import sys
+import time
 
 def is_last_model(kwargs):
     """
@@ -21,81 +22,145 @@ def is_last_model(kwargs):
     # Otherwise, run it for each of the last five apps in INSTALLED_APPS
     return kwargs['app'].__name__ in ["%s.models" % app for app in settings.INSTALLED_APPS[-5:]]
 
-def check_role_permissions(role, permissions, current_permissions):
+def get_permission_ids(apps):
+    """
+    Returns a dict of the 'app.codename' keys of all the permissions in the passed in apps to their ids,
+    loaded in a single query.
+    """
+    ids = dict()
+    if apps:
+        for (id, app, codename) in Permission.objects.filter(content_type__app_label__in=apps)\
+                                                     .values_list('id', 'content_type__app_label', 'codename'):
+            ids.setdefault("%s.%s" % (app, codename), id)
+    return ids
+
+def get_role_links(role):
+    """
+    Returns the through model which links the passed in role to its global permissions, and the name of
+    the role's field on it.
+    """
+    if isinstance(role, Group):
+        return (Group.permissions.through, 'group')
+    else:
+        return (User.user_permissions.through, 'user')
+
+def check_role_permissions(role, permissions, current_permissions, dry_run=False):
     """
     Checks the the passed in role (can be user, group or AnonymousUser)  has all the passed 
     in permissions, granting them if necessary.
+
+    Rather than granting and removing permissions one at a time, we work out which permissions the
+    role should have and which it already has in a few queries, then add and remove the difference
+    in bulk.  Returns the sorted keys of the permissions added and removed, which with dry_run are
+    only worked out and not actually changed.  Callers making several changes should make them in their
+    own transaction, as sync_all_permissions does.
     """
-    role_permissions = []
-    
-    # get all the current permissions, we'll remove these as we verify they should still be granted
+    # first parse our permissions into apps and codenames, or apps and objects for wildcards
+    specs = []
     for permission in permissions:
         splits = permission.split(".")
         if len(splits) != 2 and len(splits) != 3:
             sys.stderr.write("  invalid permission %s, ignoring\n" % permission)
             continue
 
-        app = splits[0]
-        codenames = []
+        if len(splits) == 3 and splits[2] != '*':
+            sys.stderr.write("  invalid permission %s, ignoring\n" % permission)
+            continue
 
-        if len(splits) == 2:
-            codenames.append(splits[1])
-        else:
-            (object, action) = splits[1:]
-
-            # if this is a wildcard, then query our database for all the permissions that exist on this object
-            if action == '*':
-                for perm in Permission.objects.filter(codename__startswith="%s_" % object, content_type__app_label=app):
-                    codenames.append(perm.codename)
-            # otherwise, this is an error, continue
-            else:
-                sys.stderr.write("  invalid permission %s, ignoring\n" % permission)
-                continue                
-
-        if len(codenames) == 0:
-            continue                            
-
-        for codename in codenames:
-            # the full codename for this permission
-            full_codename = "%s.%s" % (app, codename)
-            
-            # this marks all the permissions which should remain
-            role_permissions.append(full_codename)
-
-            try:
-                assign(full_codename, role)
-            except ObjectDoesNotExist:
-                pass
-#                sys.stderr.write("  unknown permission %s, ignoring\n" % permission)                
-
-    # remove any that are extra
+        specs.append(splits)
+
+    # the keys of the permissions the role currently has, we'll remove these unless they should still be granted
+    current_keys = []
     for permission in current_permissions:
         if isinstance(permission, unicode):
-            key = permission
+            current_keys.append(permission)
+        else:
+            # content types are cached by id, so this doesn't cost a query per permission
+            app = ContentType.objects.get_for_id(permission.content_type_id).app_label
+            current_keys.append("%s.%s" % (app, permission.codename))
+
+    # load all the permissions we might need in one go
+    apps = set([splits[0] for splits in specs] + [key.split('.')[0] for key in current_keys])
+    permission_ids = get_permission_ids(apps)
+
+    # this marks all the permissions which should remain
+    role_permissions = set()
+    for splits in specs:
+        app = splits[0]
+
+        # if this is a wildcard, then find all the permissions that exist on this object
+        if len(splits) == 3:
+            prefix = "%s.%s_" % (app, splits[1])
+            role_permissions.update([key for key in permission_ids if key.startswith(prefix)])
         else:
-            key = "%s.%s"  % (permission.content_type.app_label, permission.codename)
+            role_permissions.add("%s.%s" % (app, splits[1]))
+
+    wanted_ids = set([permission_ids[key] for key in role_permissions if key in permission_ids])
+    extra_ids = set([permission_ids[key] for key in current_keys
+                     if not key in role_permissions and key in permission_ids])
+
+    # now see what our role is actually linked to, roles which don't exist yet aren't linked to anything
+    (through, field) = get_role_links(role)
+    links = through.objects.filter(**{field: role})
+    linked_ids = set(links.values_list('permission_id', flat=True)) if role.pk else set()
+
+    added_ids = wanted_ids - linked_ids
+    removed_ids = extra_ids & linked_ids
+
+    keys = dict([(id, key) for (key, id) in permission_ids.items()])
+    changes = (sorted([keys[id] for id in added_ids]), sorted([keys[id] for id in removed_ids]))
+
+    if dry_run or (not added_ids and not removed_ids):
+        return changes
+
+    if removed_ids:
+        links.filter(permission__in=removed_ids).delete()
 
-        if not key in role_permissions:
-            remove_perm(key, role)
+    if added_ids:
+        through.objects.bulk_create([through(**{field: role, 'permission_id': id}) for id in added_ids])
 
-def check_all_group_permissions(sender, **kwargs):
+    # bulk changes don't send m2m_changed, so invalidate our cached permissions ourselves
+    invalidate_permissions()
+
+    return changes
+
+def describe_changes(name, changes):
     """
-    Checks that all the permissions specified in our settings.py are set for our groups.
+    Describes the added and removed permissions returned by check_role_permissions for the passed in role name
     """
-    if not is_last_model(kwargs):
-        return
+    (added, removed) = changes
+    return ["+ %s: %s" % (name, key) for key in added] + ["- %s: %s" % (name, key) for key in removed]
 
+def sync_enabled(kwargs):
+    """
+    Returns whether our permissions should be synced by this post_syncdb.  Projects which would rather run
+    the sync_permissions command once per deploy can turn this off with the PERMISSIONS_SYNCDB setting.
+    """
+    return getattr(settings, 'PERMISSIONS_SYNCDB', True) and is_last_model(kwargs)
+
+def sync_group_permissions(dry_run=False):
+    """
+    Makes sure all our groups exist and have exactly the permissions specified in GROUP_PERMISSIONS.
+    Returns a description of each change made, or just worked out with dry_run.
+    """
     config = getattr(settings, 'GROUP_PERMISSIONS', dict())
+    changes = []
 
     # for each of our items
     for name, permissions in config.items():
         # get or create the group
-        (group, created) = Group.objects.get_or_create(name=name)
-        if created:
-            pass
-#            sys.stderr.write("Added %s group\n" % name)
+        group = Group.objects.filter(name=name)[:1]
+        group = group[0] if group else Group(name=name)
+
+        if not group.pk:
+            changes.append("+ group %s" % name)
+            if not dry_run:
+                group.save()
 
-        check_role_permissions(group, permissions, group.permissions.all())
+        current = group.permissions.all() if group.pk else []
+        changes += describe_changes(name, check_role_permissions(group, permissions, current, dry_run=dry_run))
+
+    return changes
 
 def get_or_create_anonymous_user():
     try:
@@ -106,26 +171,29 @@ def get_or_create_anonymous_user():
 
     return anon_user
 
-def check_all_anon_permissions(sender, **kwargs):
+def sync_anon_permissions(dry_run=False):
     """
-    Checks that all our anonymous permissions have been granted
+    Makes sure our anonymous user exists and has been granted all our ANONYMOUS_PERMISSIONS.  Returns a
+    description of each change made, or just worked out with dry_run.
     """
-    if not is_last_model(kwargs):
-        return
-
     permissions = getattr(settings, 'ANONYMOUS_PERMISSIONS', [])
-    anon_user = get_or_create_anonymous_user()
 
-    check_role_permissions(anon_user, permissions, anon_user.get_all_permissions())
+    if dry_run:
+        try:
+            anon_user = get_anonymous_user()
+        except User.DoesNotExist:
+            return ["+ anonymous user"] + ["+ anonymous: %s" % permission for permission in permissions]
+    else:
+        anon_user = get_or_create_anonymous_user()
+
+    changes = check_role_permissions(anon_user, permissions, anon_user.get_all_permissions(), dry_run=dry_run)
+    return describe_changes("anonymous", changes)
 
 def add_permission(content_type, permission):
     """
     Adds the passed in permission to that content type.  Note that the permission passed
     in should be a single word, or verb.  The proper 'codename' will be generated from that.
     """
-    # bail if we already handled this model
-    key = "%s:%s" % (content_type.model, permission)
-    
     # build our permission slug
     codename = "%s_%s" % (content_type.model, permission)
 
@@ -134,17 +202,33 @@ def add_permission(content_type, permission):
         Permission.objects.create(content_type=content_type,
                                   codename=codename,
                                   name="Can %s %s" % (permission, content_type.name))
-#        sys.stderr.write("Added %s permission for %s\n" % (permission, content_type.name))
 
-def check_all_permissions(sender, **kwargs):
+def sync_permissions(dry_run=False):
     """
-    This syncdb checks our PERMISSIONS setting in settings.py and makes sure all those permissions
-    actually exit.
-    """
-    if not is_last_model(kwargs):
-        return
+    Makes sure all the permissions in our PERMISSIONS setting exist.  Returns a description of each
+    permission created, or just found to be missing with dry_run.
 
+    All our content types and their existing permissions are loaded up front, then any which are missing
+    are created in bulk.
+    """
     config = getattr(settings, 'PERMISSIONS', dict())
+    if not config:
+        return []
+
+    content_types = list(ContentType.objects.all())
+    by_natural_key = dict([((content_type.app_label, content_type.model), content_type)
+                           for content_type in content_types])
+
+    existing = set(Permission.objects.values_list('content_type_id', 'codename'))
+    missing = []
+
+    def add(content_type, permission):
+        codename = "%s_%s" % (content_type.model, permission)
+        if not (content_type.id, codename) in existing:
+            existing.add((content_type.id, codename))
+            missing.append(Permission(content_type=content_type,
+                                      codename=codename,
+                                      name="Can %s %s" % (permission, content_type.name)))
 
     # for each of our items
     for natural_key, permissions in config.items():
@@ -152,22 +236,56 @@ def check_all_permissions(sender, **kwargs):
         # if the natural key '*' then that means add to all objects
         if natural_key == '*':
             # for each of our content types
-            for content_type in ContentType.objects.all():
+            for content_type in content_types:
                 for permission in permissions:
-                    add_permission(content_type, permission)
+                    add(content_type, permission)
 
         # otherwise, this is on a specific content type, add for each of those
         else:
-            app, model = natural_key.split('.')
-            try:
-                content_type = ContentType.objects.get_by_natural_key(app, model)
-            except ContentType.DoesNotExist:
+            content_type = by_natural_key.get(tuple(natural_key.split('.')))
+            if not content_type:
                 continue
 
             # add each permission
             for permission in permissions:
-                add_permission(content_type, permission)
+                add(content_type, permission)
+
+    if missing and not dry_run:
+        Permission.objects.bulk_create(missing)
+
+    return ["+ %s.%s" % (permission.content_type.app_label, permission.codename) for permission in missing]
+
+def sync_all_permissions(dry_run=False):
+    """
+    Syncs our permissions, then the permissions of our groups and anonymous user, all in a single transaction
+    so a failure part way through never leaves them half synced.  Returns a list of the name of each phase,
+    the changes it made, or just worked out with dry_run, and how long it took in seconds.
+    """
+    phases = (("permissions", sync_permissions),
+              ("group permissions", sync_group_permissions),
+              ("anonymous permissions", sync_anon_permissions))
+    results = []
+
+    with transaction.commit_on_success():
+        for (name, sync) in phases:
+            start = time.time()
+            changes = sync(dry_run=dry_run)
+            results.append((name, changes, time.time() - start))
+
+    # permissions cached while we were syncing may be from before we committed
+    if not dry_run:
+        invalidate_permissions()
+
+    return results
+
+def check_all_permissions(sender, **kwargs):
+    """
+    This syncdb checks our PERMISSIONS setting in settings.py and makes sure all those permissions
+    actually exist, and that our groups and anonymous user have been granted theirs.
+    """
+    if not sync_enabled(kwargs):
+        return
+
+    sync_all_permissions()
 
 post_syncdb.connect(check_all_permissions)
-post_syncdb.connect(check_all_group_permissions)
-post_syncdb.connect(check_all_anon_permissions)
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+from django.core.urlresolvers import get_resolver
+from smartmin.views import crudl_timing_report
+
+class Command(BaseCommand):
+    help = "Loads our URLs and prints how long building the URL patterns of each CRUDL took, slowest first"
+
+    def handle(self, *args, **options):
+        # our root urlconf is only loaded the first time it is used
+        get_resolver(None).url_patterns
+
+        self.stdout.write("%s\n" % crudl_timing_report())
@@ -0,0 +1,26 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from smartmin.management import sync_all_permissions
+
+class Command(BaseCommand):
+    help = "Creates the permissions in PERMISSIONS and grants those in GROUP_PERMISSIONS and ANONYMOUS_PERMISSIONS"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+                    help="Print the changes which would be made without making them"),
+    )
+
+    def handle(self, *args, **options):
+        dry_run = options.get('dry_run', False)
+
+        # note that with a dry run, grants of permissions which don't exist yet aren't shown
+        for (name, changes, elapsed) in sync_all_permissions(dry_run=dry_run):
+            for change in changes:
+                self.stdout.write("  %s\n" % change)
+
+            verb = "would be made" if dry_run else "made"
+            self.stdout.write("%s: %d change(s) %s in %.3fs\n" % (name.capitalize(), len(changes), verb, elapsed))
+
+        if dry_run:
+            self.stdout.write("Dry run, nothing was changed\n")
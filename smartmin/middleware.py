@@ -1,6 +1,17 @@
+from django.conf import settings
 from django.http import HttpResponseRedirect, HttpResponse
-from django.http import HttpResponse
-import sys, StringIO, os
+from django.utils.html import escape
+from smartmin import class_from_string
+import cProfile
+import datetime
+import os
+import pstats
+import random
+import StringIO
+import sys
+import thread
+import threading
+import time
 
 class AjaxRedirect(object):
     def process_response(self, request, response):
@@ -13,42 +24,206 @@ class AjaxRedirect(object):
                 response.status_code = 302
         return response
 
-class ProfileMiddleware():
-    def __init__(self):
-        pass
-    
-    def process_view(self, request, view, *args, **kwargs):
-        import hotshot, hotshot.stats
-        
-        for item in request.META['QUERY_STRING'].split('&'):
-            if item.split('=')[0] == 'profile': # profile in query string
-                # catch the output, must happen before stats object is created
-                # see https://bugs.launchpad.net/webpy/+bug/133080 for the details
-                std_old, std_new = sys.stdout, StringIO.StringIO()
-                sys.stdout = std_new
+# the most recent profiles taken by ProfileMiddleware in this process, newest last
+_profiles = []
+_profiles_lock = threading.Lock()
 
-                # now let's do some profiling
-                tmpfile = '/tmp/%s' % request.COOKIES['sessionid']
-                prof = hotshot.Profile(tmpfile)
+def get_profiles():
+    """
+    Returns the profiles kept in memory by ProfileMiddleware, newest last
+    """
+    with _profiles_lock:
+        return list(_profiles)
 
-                # make a call to the actual view function with the given arguments
-                response = prof.runcall(view, request, *args[0], **args[1])
-                prof.close()
+def store_profile(profile):
+    """
+    Keeps the passed in profile in memory, dropping the oldest once there are more than PROFILE_STORE_SIZE,
+    and saves it to PROFILE_DIR if that is set
+    """
+    size = getattr(settings, 'PROFILE_STORE_SIZE', 50)
 
-                # and then statistical reporting
-                stats = hotshot.stats.load(tmpfile)
-                stats.strip_dirs()
-                stats.sort_stats('time')
+    with _profiles_lock:
+        _profiles.append(profile)
+        del _profiles[:-size]
 
-                # do the output
-                stats.print_stats(1.0)
+    directory = getattr(settings, 'PROFILE_DIR', None)
+    if directory:
+        profile.save(directory)
 
-                # restore default output
-                sys.stdout = std_old
+class StackSampler(object):
+    """
+    Samples the stack of a single thread every interval seconds from a thread of its own, counting
+    how often each stack is seen.  This costs the sampled thread very little, unlike cProfile.
+    """
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.counts = dict()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
 
-                # delete file
-                os.remove(tmpfile)
+    def start(self):
+        self.thread.start()
 
-                return HttpResponse('<pre>%s</pre>' % std_new.getvalue())
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
 
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+
+            stack = []
+            while frame:
+                code = frame.f_code
+                stack.append("%s:%s" % (os.path.basename(code.co_filename), code.co_name))
+                frame = frame.f_back
+
+            if stack:
+                key = ";".join(reversed(stack))
+                self.counts[key] = self.counts.get(key, 0) + 1
+
+            # no sense holding on to the frames of our sampled thread any longer than we need to
+            del frame
+
+    def folded(self):
+        """
+        Returns our samples as folded stacks, one per line followed by how many times it was seen, as
+        read by flamegraph.pl and most other flame graph tools
+        """
+        return "".join(["%s %d\n" % (stack, count) for (stack, count) in sorted(self.counts.items())])
+
+class RequestProfile(object):
+    """
+    The profile of a single request, either the stats collected by cProfile or the stacks sampled by
+    a StackSampler
+    """
+    def __init__(self, request, mode, duration, profiler):
+        self.path = request.path
+        self.method = request.method
+        self.mode = mode
+        self.duration = duration
+        self.created_on = datetime.datetime.now()
+        self.profiler = profiler
+
+    def report(self):
+        """
+        Returns a readable report of this profile, cProfile stats sorted by time or our sampled stacks
+        """
+        if self.mode == 'sample':
+            return self.profiler.folded()
+
+        output = StringIO.StringIO()
+        stats = pstats.Stats(self.profiler, stream=output)
+        stats.strip_dirs()
+        stats.sort_stats('time')
+        stats.print_stats(1.0)
+        return output.getvalue()
+
+    def save(self, directory):
+        """
+        Saves this profile to the passed in directory, as a pstats file for cProfile, or as folded
+        stacks for sampling.  Returns the path of the file written.
+        """
+        name = "%s-%s-%s" % (self.created_on.strftime("%Y%m%d%H%M%S%f"), self.method,
+                             self.path.strip('/').replace('/', '_') or 'root')
+
+        if self.mode == 'sample':
+            filename = os.path.join(directory, "%s.folded" % name)
+            with open(filename, 'w') as output:
+                output.write(self.profiler.folded())
+        else:
+            filename = os.path.join(directory, "%s.pstats" % name)
+            self.profiler.dump_stats(filename)
+
+        return filename
+
+    def __unicode__(self):
+        return "%s %s (%s, %.3fs)" % (self.method, self.path, self.mode, self.duration)
+
+class ProfileMiddleware(object):
+    """
+    Profiles requests with 'profile' in their query string, returning the profile instead of the response.
+    'profile=sample' or 'profile=cprofile' picks how we profile, otherwise PROFILE_MODE does, cprofile by
+    default.  This is only honoured when DEBUG is on, for superusers, or when PROFILE_ALLOWED, a function or
+    the dotted path of one, returns True for the request.
+
+    A PROFILE_SAMPLE_RATE fraction of all other requests are also profiled, returning their response as
+    usual.  Profiles are kept in memory, see get_profiles(), and saved to PROFILE_DIR if that is set.
+
+    Profiling starts once the view is resolved and stops when this middleware sees the response, so the
+    request goes through every other middleware as usual.  List this first in MIDDLEWARE_CLASSES so that
+    the response middleware of all the others is profiled too.
+    """
+    MODES = ('cprofile', 'sample')
+
+    def can_profile(self, request):
+        """
+        Whether the passed in request may ask to be profiled
+        """
+        if settings.DEBUG:
+            return True
+
+        user = getattr(request, 'user', None)
+        if user and user.is_superuser:
+            return True
+
+        allowed = getattr(settings, 'PROFILE_ALLOWED', None)
+        if isinstance(allowed, basestring):
+            allowed = class_from_string(allowed)
+
+        return bool(allowed and allowed(request))
+
+    def process_view(self, request, view, view_args, view_kwargs):
+        mode = None
+        requested = False
+
+        for item in request.META.get('QUERY_STRING', '').split('&'):
+            (key, _, value) = item.partition('=')
+            if key == 'profile':  # profile in query string
+                requested = True
+                mode = value if value in ProfileMiddleware.MODES else None
+
+        if requested and not self.can_profile(request):
+            requested = False
+            mode = None
+
+        if not requested:
+            rate = getattr(settings, 'PROFILE_SAMPLE_RATE', 0)
+            if not rate or random.random() >= rate:
+                return None
+
+        if not mode:
+            mode = getattr(settings, 'PROFILE_MODE', 'cprofile')
+
+        # each request is profiled on its own thread, so concurrent requests don't see each other's profiles
+        if mode == 'sample':
+            profiler = StackSampler(thread.get_ident(), getattr(settings, 'PROFILE_SAMPLE_INTERVAL', 0.005))
+            profiler.start()
+        else:
+            profiler = cProfile.Profile()
+            profiler.enable()
+
+        request._profile = (mode, requested, profiler, time.time())
         return None
+
+    def process_response(self, request, response):
+        if not getattr(request, '_profile', None):
+            return response
+
+        (mode, requested, profiler, start) = request._profile
+        request._profile = None
+
+        if mode == 'sample':
+            profiler.stop()
+        else:
+            profiler.disable()
+
+        profile = RequestProfile(request, mode, time.time() - start, profiler)
+        store_profile(profile)
+
+        if requested:
+            return HttpResponse('<pre>%s</pre>' % escape(profile.report()))
+
+        return response
@@ -1,10 +1,20 @@
 import csv
+import operator
+import re
 import traceback
 import simplejson
-from django.db import models
+from django.core.exceptions import ImproperlyConfigured, ValidationError
+from django.db import connection, models, transaction
+from django.db.models import Q, signals
+from django.dispatch.dispatcher import _make_id
+from django.utils.datastructures import SortedDict
 from django.contrib.auth.models import User
 import codecs
 
+# these are latin accented characters in mac_roman but aren't defined in cp1252, if we see them then our
+# alternative encoding should be mac_roman
+MAC_ROMAN_BYTES = re.compile('[\x81\x8d\x8f\x90\x9d]')
+
 class SmartModel(models.Model):
     """
     Useful abstract base class that adds the concept of something being active,
@@ -24,6 +34,23 @@ class SmartModel(models.Model):
     modified_on = models.DateTimeField(auto_now=True,
                                        help_text="When this item was last modified")
 
+    # how many imported rows are inserted at a time, set to 1 to insert every row as it is read
+    import_batch_size = 1000
+
+    # how much of an imported file we read at a time when guessing its encoding
+    import_detect_bytes = 65536
+
+    # imported files larger than this many bytes are split into chunks of about this size which are imported
+    # in parallel, None to always import files as a whole
+    import_chunk_bytes = None
+
+    # the fields which identify an existing row, imported rows which match one update it rather than being
+    # inserted as a new row, None to always insert.  These can't be used by models overriding create_instance()
+    import_natural_keys = None
+
+    # whether imports are committed a batch at a time, so that they can be resumed if they die part way through
+    import_resumable = False
+
     class Meta:
         abstract = True
 
@@ -36,29 +63,263 @@ class SmartModel(models.Model):
         return cls.objects.create(**field_dict)
 
     @classmethod
-    def import_csv(cls, task, log=None):
+    def can_bulk_import(cls):
+        """
+        Whether our imported rows can be inserted in batches using bulk_create.  This isn't possible for models
+        which create their own instances, which inherit from other concrete models, or which rely on save()
+        being called, either by overriding it or by having pre_save or post_save receivers.
+        """
+        if cls.create_instance.im_func is not SmartModel.create_instance.im_func or cls._meta.parents:
+            return False
 
-        file = task.csv_file.file
-        user = task.created_by
+        if cls.save.im_func is not models.Model.save.im_func:
+            return False
 
-        import_params = None
-        if task.import_params:
-            import_params = simplejson.loads(task.import_params)
+        # bulk_create() sends neither signal, receivers connected to every sender count too
+        for signal in (signals.pre_save, signals.post_save):
+            if signal._live_receivers(_make_id(cls)):
+                return False
+
+        return True
+
+    @classmethod
+    def natural_key_for(cls, instance):
+        return tuple([cls._meta.get_field(name).to_python(getattr(instance, cls._meta.get_field(name).attname))
+                      for name in cls.import_natural_keys])
+
+    @classmethod
+    def lookup_natural_keys(cls, keys):
+        """
+        Returns a dict of the passed in natural keys to the primary keys of the existing rows they match,
+        found with a single query.
+        """
+        names = list(cls.import_natural_keys)
+
+        if len(names) == 1:
+            existing = cls.objects.filter(**{'%s__in' % names[0]: [key[0] for key in keys]})
+        else:
+            existing = cls.objects.filter(reduce(operator.or_, [Q(**dict(zip(names, key))) for key in keys]))
+
+        return dict([(tuple(row[1:]), row[0]) for row in existing.values_list('pk', *names)])
+
+    @classmethod
+    def updated_fields(cls, names):
+        """
+        Returns the fields an imported row with the passed in field names sets when it updates an existing row,
+        those it has values for and who modified it and when, but never who created it or when
+        """
+        names = set(names) | set(['modified_by', 'modified_on'])
+        return [field for field in cls._meta.fields
+                if (field.name in names or field.attname in names) and not field.primary_key
+                and field.name not in ('created_by', 'created_on')]
+
+    @classmethod
+    def save_instances(cls, instances, names=None):
+        """
+        Saves the passed in instances, inserting them all with a single bulk_create.  If we have natural keys,
+        those which match existing rows update them instead.  Only the fields named in the passed in list,
+        one list of names per instance, are updated, see updated_fields(), every field if none is given.
+        """
+        if not cls.import_natural_keys:
+            cls.objects.bulk_create(instances)
+            return instances
+
+        if names is None:
+            names = [[field.name for field in cls._meta.fields]] * len(instances)
+
+        # if a key is repeated the last row for it wins, just as if each row had been saved in turn
+        keys = [cls.natural_key_for(instance) for instance in instances]
+        by_key = SortedDict()
+        for (key, instance, instance_names) in zip(keys, instances, names):
+            by_key[key] = (instance, instance_names)
+
+        existing = cls.lookup_natural_keys(by_key.keys())
+
+        # updates go first, they can safely be repeated if our insert fails and we retry a row at a time
+        for (key, (instance, instance_names)) in by_key.items():
+            if key in existing:
+                instance.pk = existing[key]
+                values = dict([(field.name, field.pre_save(instance, False)) for field in cls.updated_fields(instance_names)])
+                cls.objects.filter(pk=instance.pk).update(**values)
+
+        cls.objects.bulk_create([instance for (key, (instance, instance_names)) in by_key.items() if key not in existing])
+
+        # every row is returned, those which repeated a key as the instance which won
+        return [by_key[key][0] for key in keys]
+
+    @classmethod
+    def save_instance(cls, field_values):
+        """
+        Saves a single imported row, used when rows can't be bulk imported.  If we have natural keys and the
+        row matches an existing one, that is updated with save(), leaving who created it and when alone.
+        """
+        if not cls.import_natural_keys:
+            return cls.create_instance(field_values)
+
+        instance = cls(**field_values)
+        existing = cls.lookup_natural_keys([cls.natural_key_for(instance)])
+        if existing:
+            instance = cls.objects.get(pk=existing.values()[0])
+            for (name, value) in field_values.items():
+                if name not in ('created_by', 'created_on'):
+                    setattr(instance, name, value)
+
+        instance.save()
+        return instance
+
+    @classmethod
+    def create_instances(cls, batch, log=None):
+        """
+        Saves the passed in batch of (line number, field values, instance) tuples in one go.  If that fails we
+        roll it back and save the rows one at a time instead, so that we can report which line is at fault.
+
+        Without savepoints a failed batch can't be rolled back on its own, bulk_create may already have inserted
+        some of it, so we instead check every row first and only insert those before the first bad one.
+        """
+        if not batch:
+            return []
+
+        def save(rows):
+            return cls.save_instances([instance for (line_number, field_values, instance) in rows],
+                                      [field_values.keys() for (line_number, field_values, instance) in rows])
+
+        if not connection.features.uses_savepoints:
+            fields = [field for field in cls._meta.fields if not field.rel]
+
+            for (index, (line_number, field_values, instance)) in enumerate(batch):
+                try:
+                    # we only check values convert to their field's type, which is what usually fails an insert
+                    for field in fields:
+                        if field.name in field_values:
+                            field.to_python(getattr(instance, field.attname))
+                except Exception as e:
+                    save(batch[:index])
+                    if log:
+                        traceback.print_exc(100, log)
+                    raise Exception("Line %d: %s\n\n%s" % (line_number, str(e), field_values))
+
+            try:
+                return save(batch)
+            except Exception as e:
+                if log:
+                    traceback.print_exc(100, log)
+                raise Exception("Lines %d to %d: %s" % (batch[0][0], batch[-1][0], str(e)))
+
+        sid = transaction.savepoint()
+        try:
+            instances = save(batch)
+            transaction.savepoint_commit(sid)
+            return instances
+
+        except Exception:
+            transaction.savepoint_rollback(sid)
+
+        instances = []
+        for (line_number, field_values, instance) in batch:
+            try:
+                if cls.import_natural_keys:
+                    instances += cls.save_instances([instance], [field_values.keys()])
+                else:
+                    instances.append(cls.create_instance(field_values))
+            except Exception as e:
+                if log:
+                    traceback.print_exc(100, log)
+                raise Exception("Line %d: %s\n\n%s" % (line_number, str(e), field_values))
+
+        return instances
+
+    @classmethod
+    def read_csv_header(cls, reader):
+        """
+        Reads the header from the passed in CSV reader, skipping any comments before it.  Returns a tuple of
+        the header and the number of lines read.
+        """
+        line_number = 0
+
+        header = reader.next()
+        line_number += 1
+        while header is not None and len(header[0]) > 1 and header[0][0] == "#":
+            header = reader.next()
+            line_number += 1
+
+        # do some sanity checking to make sure they uploaded the right kind of file
+        if len(header) < 1:
+            raise Exception("Invalid header for import file")
+
+        return header, line_number
+
+    @classmethod
+    def split_csv(cls, task):
+        """
+        Splits the file of the passed in import task into chunks of about import_chunk_bytes each.  Returns a
+        list of (start, end, line number) tuples, giving the byte range of each chunk and the number of the
+        line before it, with None as the end of the last chunk.  Chunks always end on a row boundary, so quoted
+        values which span lines are never split.  If our file can't be parsed it is returned as a single chunk,
+        so that the import reports the row at fault.
+        """
+        reader = open(task.csv_file.file.name, "rU")
+
+        try:
+            # the csv module reads a line at a time, so tell() always gives us where the last row ended
+            rows = csv.reader(iter(reader.readline, ''))
+            header, line_number = cls.read_csv_header(rows)
+
+            first = (reader.tell(), None, line_number)
+            chunks = []
+            start = reader.tell()
+            start_line = line_number
+
+            try:
+                for row in rows:
+                    line_number += 1
+
+                    if cls.import_chunk_bytes and reader.tell() - start >= cls.import_chunk_bytes:
+                        chunks.append((start, reader.tell(), start_line))
+                        start = reader.tell()
+                        start_line = line_number
+
+            except csv.Error:
+                return [first]
+
+            if not chunks or reader.tell() > start:
+                chunks.append((start, None, start_line))
+
+            return chunks
 
-        # our alternative codec, by default we are the crazy windows encoding
-        ascii_codec = 'cp1252'
+        finally:
+            reader.close()
 
-        # read the entire file, look for mac_roman characters
-        reader = open(file.name, "rb")
-        for byte in reader.read():
-            # these are latin accented characterse in mac_roman, if we see them then our alternative
-            # encoding should be mac_roman
-            if ord(byte) in [0x81, 0x8d, 0x8f, 0x90, 0x9d]:
-                ascii_codec = 'mac_roman'
-                break
-        reader.close()
+    @classmethod
+    def detect_codec(cls, task):
+        """
+        Returns the codec non-ascii values in the file of the passed in import task are decoded with.  By
+        default we are the crazy windows encoding, unless our file has mac_roman characters anywhere in it.
+        The whole file is scanned, import_detect_bytes at a time, so every row is decoded the same way.
+        """
+        csv_input = open(task.csv_file.file.name, "rb")
+        try:
+            for block in iter(lambda: csv_input.read(cls.import_detect_bytes), ''):
+                if MAC_ROMAN_BYTES.search(block):
+                    return 'mac_roman'
+        finally:
+            csv_input.close()
 
-        reader = open(file.name, "rU")
+        return 'cp1252'
+
+    @classmethod
+    def read_csv(cls, task, chunk=None, codec=None):
+        """
+        Opens the file of the passed in import task, or just the passed in chunk of it as returned by
+        split_csv().  Returns a tuple of our header and a generator of (line number, offset, row) tuples for
+        the rows that follow it, offset being where in the file that row ends.
+
+        Non-ascii values are decoded with the passed in codec, detected from our file if none is given.
+        """
+        if codec is None:
+            codec = cls.detect_codec(task)
+
+        file = task.csv_file.file
+        csv_input = open(file.name, "rU")
 
         def unicode_csv_reader(utf8_data, dialect=csv.excel, **kwargs):
             csv_reader = csv.reader(utf8_data, dialect=dialect, **kwargs)
@@ -68,36 +329,88 @@ class SmartModel(models.Model):
                     try: 
                         cell = unicode(cell)
                     except:
-                        cell = unicode(cell.decode(ascii_codec))
+                        cell = unicode(cell.decode(codec))
                         
                     encoded.append(cell)
 
                 yield encoded
 
-        reader = unicode_csv_reader(reader)
+        def read_lines(end=None, counted=True):
+            # we read a line at a time so that tell() always gives us our real position
+            position = csv_input.tell()
+            while end is None or position < end:
+                line = csv_input.readline()
+                if not line:
+                    break
 
-        # read in our header
-        line_number = 0
+                if counted:
+                    task.record_progress(bytes_read=csv_input.tell() - position)
 
-        header = reader.next()
-        line_number += 1
-        while header is not None and len(header[0]) > 1 and header[0][0] == "#":
-            header = reader.next()
-            line_number += 1
+                position = csv_input.tell()
+                yield line
 
-        # do some sanity checking to make sure they uploaded the right kind of file
-        if len(header) < 1:
-            raise Exception("Invalid header for import file")
+        # our header is always at the start of our file, chunks are read from where they start
+        header, line_number = cls.read_csv_header(unicode_csv_reader(read_lines(counted=chunk is None)))
 
-        records = []
-        for row in reader:
-            # trim all our values
-            row = [val.strip() for val in row]
+        end = None
+        if chunk:
+            (start, end, line_number) = chunk
+            csv_input.seek(start)
 
-            line_number += 1
+        def read_rows(line_number):
+            for row in unicode_csv_reader(read_lines(end)):
+                line_number += 1
+
+                # trim all our values
+                yield line_number, csv_input.tell(), [val.strip() for val in row]
+
+            csv_input.close()
+
+        return header, read_rows(line_number)
 
+    @classmethod
+    def import_csv(cls, task, log=None, chunk=None, checkpoint=None, codec=None):
+        """
+        Imports the file of the passed in task, or just the passed in chunk of it as returned by split_csv(),
+        decoding it with the passed in codec if there is one, see read_csv()
+
+        If a checkpoint function is passed in it is called with the line number and byte offset of the last
+        row inserted every import_batch_size rows, so that the import can later be resumed from there.
+        """
+        if cls.import_natural_keys and cls.create_instance.im_func is not SmartModel.create_instance.im_func:
+            raise ImproperlyConfigured("%s overrides create_instance(), so its import_natural_keys can't be honoured"
+                                       % cls.__name__)
+
+        user = task.created_by
+
+        import_params = None
+        if task.import_params:
+            import_params = simplejson.loads(task.import_params)
+
+        def insert(batch):
+            try:
+                instances = cls.create_instances(batch, log)
+            except Exception:
+                task.record_progress(rows_failed=1)
+                raise
+
+            task.record_progress(rows_processed=len(instances))
+            return instances
+
+        header, rows = cls.read_csv(task, chunk, codec)
+
+        # rows are inserted in batches when we can, otherwise one at a time
+        bulk = cls.can_bulk_import()
+        batch_size = cls.import_batch_size if bulk else 1
+
+        records = []
+        batch = []
+        uncheckpointed = 0
+        for (line_number, offset, row) in rows:
             # make sure there are same number of fields
             if len(row) != len(header):
+                records += insert(batch)
+                task.record_progress(rows_failed=1)
                 raise Exception("Line %d: The number of fields for this row is incorrect. Expected %d but found %d." % (line_number, len(header), len(row)))
 
             field_values = dict(zip(header, row))
@@ -105,14 +418,76 @@ class SmartModel(models.Model):
             field_values['modified_by'] = user
             try:
                 field_values = cls.prepare_fields(field_values, import_params, user)
-                records.append(cls.create_instance(field_values))
+
+                if not bulk:
+                    records.append(cls.save_instance(field_values))
+                    task.record_progress(rows_processed=1)
+                else:
+                    batch.append((line_number, field_values, cls(**field_values)))
+
             except Exception as e:
                 if log:
                     traceback.print_exc(100, log)
+
+                # rows before this one are still inserted as they were read
+                records += insert(batch)
+                task.record_progress(rows_failed=1)
                 raise Exception("Line %d: %s\n\n%s" % (line_number, str(e), field_values))
 
+            if len(batch) >= batch_size:
+                records += insert(batch)
+                batch = []
+
+            uncheckpointed += 1
+            if checkpoint and not batch and uncheckpointed >= cls.import_batch_size:
+                checkpoint(line_number, offset)
+                uncheckpointed = 0
+
+        records += insert(batch)
+
+        if checkpoint and uncheckpointed:
+            checkpoint(line_number, offset)
+
         return records
 
+    @classmethod
+    def validate_csv(cls, task):
+        """
+        Checks every row of the file of the passed in task without saving anything, running each through
+        prepare_fields() and the validation of our model's fields.  Generates (line number, error) tuples for
+        the rows which would fail to import.
+        """
+        user = task.created_by
+
+        import_params = None
+        if task.import_params:
+            import_params = simplejson.loads(task.import_params)
+
+        header, rows = cls.read_csv(task)
+
+        for (line_number, offset, row) in rows:
+            error = None
+
+            if len(row) != len(header):
+                error = "The number of fields for this row is incorrect. Expected %d but found %d." % (len(header), len(row))
+
+            else:
+                field_values = dict(zip(header, row))
+                field_values['created_by'] = user
+                field_values['modified_by'] = user
+                try:
+                    field_values = cls.prepare_fields(field_values, import_params, user)
+                    cls(**field_values).clean_fields()
+                except ValidationError as e:
+                    error = "; ".join(["%s: %s" % (field, " ".join(messages)) for (field, messages) in sorted(e.message_dict.items())])
+                except Exception as e:
+                    error = str(e)
+
+            if error:
+                task.record_progress(rows_failed=1)
+                yield line_number, error
+            else:
+                task.record_progress(rows_processed=1)
 
 class ActiveManager(models.Manager):
     """
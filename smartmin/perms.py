@@ -0,0 +1,174 @@
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User, Group
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import connections, models
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from guardian.models import UserObjectPermission, GroupObjectPermission
+from guardian.utils import get_anonymous_user
+
+# our cache keys are all prefixed by a generation, which is bumped whenever permissions change
+GENERATION_KEY = 'smartmin:perms:generation'
+
+def get_cache_timeout():
+    """
+    How long cached permissions are kept for, a backstop to our signal based invalidation.
+    """
+    return getattr(settings, 'PERMISSIONS_CACHE_TIMEOUT', 300)
+
+def can_cache():
+    """
+    Whether permissions can be cached.  Other processes only see that cached permissions are invalid through
+    a shared cache, with a cache local to each process they would keep honouring revoked permissions until
+    they expire, so we don't cache with the local memory backend unless PERMISSIONS_CACHE_LOCAL says our
+    site runs in a single process.
+    """
+    return not isinstance(cache, LocMemCache) or getattr(settings, 'PERMISSIONS_CACHE_LOCAL', False)
+
+def get_generation():
+    """
+    Returns the current generation of our cached permissions.
+
+    We start generations from the current time rather than zero so that if our generation is ever evicted
+    from the cache, we can't end up reusing permissions cached under an older one.
+    """
+    generation = cache.get(GENERATION_KEY)
+    if generation is None:
+        generation = int(time.time() * 1000)
+        cache.set(GENERATION_KEY, generation, get_cache_timeout())
+
+    return generation
+
+def invalidate_permissions(sender=None, **kwargs):
+    """
+    Invalidates all our cached permissions, called whenever permissions are assigned or removed.
+    """
+    try:
+        cache.incr(GENERATION_KEY)
+    except ValueError:
+        cache.set(GENERATION_KEY, int(time.time() * 1000), get_cache_timeout())
+
+def get_max_cached_ids():
+    """
+    The most object ids we will cache for a user and permission.  Beyond this, lists are filtered with a
+    subquery instead, as long lists of ids make for huge queries, can exceed the number of parameters
+    SQLite allows and may not fit in the cache at all.
+    """
+    return getattr(settings, 'PERMISSIONS_CACHE_MAX_IDS', 500)
+
+def get_object_permissions(user_id, permission, model):
+    """
+    Returns querysets of guardian's user and group object permissions granting the user with the passed
+    in id the passed in permission on objects of the passed in model.
+    """
+    content_type = ContentType.objects.get_for_model(model)
+    codename = permission.split('.')[-1]
+
+    user_perms = UserObjectPermission.objects.filter(user=user_id, content_type=content_type,
+                                                     permission__codename=codename)
+    group_perms = GroupObjectPermission.objects.filter(group__user=user_id, content_type=content_type,
+                                                       permission__codename=codename)
+    return (user_perms, group_perms)
+
+def get_object_ids_for_user(user_id, permission, model):
+    """
+    Returns the set of primary keys of the objects of the passed in model on which the user with the passed
+    in id has been granted the passed in permission, either directly or through one of their groups.
+    Returns None if there are more than PERMISSIONS_CACHE_MAX_IDS of them.
+
+    This only looks at object permissions, global permissions should be checked with has_perm first.  The
+    result is cached until permissions change, so repeated list views don't hit guardian's tables.
+    """
+    cached = can_cache()
+    if cached:
+        key = 'smartmin:perms:%d:objects:%s:%s' % (get_generation(), user_id, permission)
+        object_ids = cache.get(key)
+    else:
+        object_ids = None
+
+    if object_ids is None:
+        (user_perms, group_perms) = get_object_permissions(user_id, permission, model)
+
+        # fetch one more than we would cache, so we know if there are too many
+        limit = get_max_cached_ids() + 1
+        pks = list(user_perms.values_list('object_pk', flat=True)[:limit]) + \
+              list(group_perms.values_list('object_pk', flat=True)[:limit])
+        object_ids = set([model._meta.pk.to_python(pk) for pk in pks])
+
+        # too many, we cache that fact instead
+        if len(object_ids) >= limit:
+            object_ids = False
+
+        if cached:
+            cache.set(key, object_ids, get_cache_timeout())
+
+    return object_ids if object_ids is not False else None
+
+def filter_by_object_permission(queryset, user_id, permission):
+    """
+    Filters the passed in queryset to the objects on which the user with the passed in id has been granted
+    the passed in permission, either directly or through one of their groups.  This uses our cached object
+    ids where there are few enough of them, and a subquery of guardian's tables otherwise.
+    """
+    model = queryset.model
+    object_ids = get_object_ids_for_user(user_id, permission, model)
+    if object_ids is not None:
+        return queryset.filter(pk__in=object_ids)
+
+    connection = connections[queryset.db]
+    qn = connection.ops.quote_name
+    pk = model._meta.pk
+
+    clauses = []
+    params = []
+    for perms in get_object_permissions(user_id, permission, model):
+        # guardian keeps object ids as strings, which PostgreSQL won't compare to integer ids without a cast
+        if connection.vendor == 'postgresql' and isinstance(pk, (models.AutoField, models.IntegerField)):
+            table = qn(perms.model._meta.db_table)
+            perms = perms.extra(select=dict(object_id="CAST(%s.%s AS integer)" % (table, qn('object_pk'))))
+            object_pks = perms.values_list('object_id', flat=True)
+        else:
+            object_pks = perms.values_list('object_pk', flat=True)
+
+        (sql, sql_params) = object_pks.query.sql_with_params()
+        clauses.append("%s.%s IN (%s)" % (qn(model._meta.db_table), qn(pk.column), sql))
+        params += list(sql_params)
+
+    return queryset.extra(where=["(%s)" % " OR ".join(clauses)], params=params)
+
+# the permissions of our anonymous user as of a particular generation, shared by the whole process
+_anonymous_permissions = (None, frozenset())
+
+def get_anonymous_permissions():
+    """
+    Returns the set of global permissions granted to guardian's anonymous user, as strings of the form
+    'app_label.codename'.  This is cached for the life of the process, until permissions change, as long
+    as we can cache permissions at all, see can_cache().
+    """
+    global _anonymous_permissions
+
+    generation = get_generation() if can_cache() else None
+    if generation is None or _anonymous_permissions[0] != generation:
+        try:
+            anon_user = get_anonymous_user()
+            permissions = frozenset(anon_user.get_all_permissions()) if anon_user.is_active else frozenset()
+        except User.DoesNotExist:
+            permissions = frozenset()
+
+        _anonymous_permissions = (generation, permissions)
+
+    return _anonymous_permissions[1]
+
+# object permissions are granted by guardian's assign and removed by remove_perm, global permissions are
+# granted to users and groups directly, and users get group permissions through their memberships, so
+# changes to any of these invalidate our cache
+post_save.connect(invalidate_permissions, sender=UserObjectPermission)
+post_delete.connect(invalidate_permissions, sender=UserObjectPermission)
+post_save.connect(invalidate_permissions, sender=GroupObjectPermission)
+post_delete.connect(invalidate_permissions, sender=GroupObjectPermission)
+m2m_changed.connect(invalidate_permissions, sender=User.groups.through)
+m2m_changed.connect(invalidate_permissions, sender=User.user_permissions.through)
+m2m_changed.connect(invalidate_permissions, sender=Group.permissions.through)
@@ -13,22 +13,65 @@ def get_list_class(context, list):
     Returns the class to use for the passed in list.  We just build something up
     from the object type for the list.
     """
-    css = "list_%s_%s" % (list.model._meta.app_label, list.model._meta.module_name)
+    # pages of results aren't always querysets, in which case we use our view's model
+    model = getattr(list, 'model', None) or context['view'].model
+    css = "list_%s_%s" % (model._meta.app_label, model._meta.module_name)
     return css
 
-def format_datetime(time):
+# the timezones we have looked up by name, shared by the whole process
+_timezones = {}
+
+def get_timezone(name):
+    """
+    Returns the pytz timezone with the passed in name, only looking up each name once
+    """
+    timezone = _timezones.get(name)
+    if timezone is None:
+        timezone = pytz.timezone(name)
+        _timezones[name] = timezone
+    return timezone
+
+def lookup_timezone(context):
+    """
+    Returns the name of the timezone dates should be shown in, that derived by our view if it has put
+    one in our context, otherwise the USER_TIME_ZONE setting if there is one
     """
-    Formats a date, converting the time to the user timezone if one is specified
+    if 'user_timezone' in context:
+        return context['user_timezone']
+
+    return getattr(settings, 'USER_TIME_ZONE', None)
+
+def format_datetimes(values, timezone=None):
+    """
+    Formats all the dates in the passed in list, converting them to the passed in timezone if there is
+    one.  Anything which isn't a date is left as is.  Timezones are only looked up once for the whole list.
     """
-    # see if a USER_TIME_ZONE is specified
-    timezone = getattr(settings, 'USER_TIME_ZONE', None)
     if timezone:
-        db_tz = pytz.timezone(settings.TIME_ZONE)
-        local_tz = pytz.timezone(settings.USER_TIME_ZONE)
-        time = time.replace(tzinfo=db_tz).astimezone(local_tz)
+        db_tz = get_timezone(settings.TIME_ZONE)
+        local_tz = get_timezone(timezone)
+
+    formatted = []
+    for value in values:
+        if type(value) == datetime:
+            if timezone:
+                # naive dates are in our database timezone, localize() gets its offset right for that date
+                if value.tzinfo is None:
+                    value = db_tz.localize(value)
+                value = value.astimezone(local_tz)
+            value = value.strftime("%b %d, %Y %H:%M")
+        formatted.append(value)
+
+    return formatted
+
+def format_datetime(time, timezone=None):
+    """
+    Formats a date, converting the time to the passed in timezone, or the USER_TIME_ZONE setting
+    if one is specified
+    """
+    if timezone is None:
+        timezone = getattr(settings, 'USER_TIME_ZONE', None)
 
-    # print it out
-    return time.strftime("%b %d, %Y %H:%M")
+    return format_datetimes([time], timezone)[0]
 
 @register.simple_tag(takes_context=True)
 def get_value_from_view(context, field):
@@ -47,7 +90,7 @@ def get_value_from_view(context, field):
 
     # it's a date
     if type(value) == datetime:
-        return format_datetime(value)
+        return format_datetimes([value], lookup_timezone(context))[0]
 
     return value
 
@@ -62,10 +105,26 @@ def get_value(context, obj, field):
     view = context['view']
     value = view.lookup_field_value(context, obj, field)
     if type(value) == datetime:
-        return format_datetime(value)
+        return format_datetimes([value], lookup_timezone(context))[0]
 
     return value
 
+@register.assignment_tag(takes_context=True)
+def get_table_rows(context, object_list, fields):
+    """
+    Builds all the rows of our list table at once, rather than looking up each cell with get_value,
+    get_class and get_field_link.  Dates are formatted the same way get_value formats them.
+    """
+    view = context['view']
+    rows = view.lookup_table_rows(context, object_list, fields)
+
+    cells = [cell for row in rows for cell in row['cells']]
+    values = format_datetimes([cell['value'] for cell in cells], lookup_timezone(context))
+    for (cell, value) in zip(cells, values):
+        cell['value'] = value
+
+    return rows
+
 @register.simple_tag(takes_context=True)
 def get_class(context, field, obj=None):
     """
@@ -130,6 +189,21 @@ def get(dictionary, key):
     else:
         return ''
 
+@register.filter
+def approximate_count(count):
+    """
+    Rounds large counts to something friendlier, 1234567 becoming 1.2M for example
+    """
+    if count < 1000:
+        return str(count)
+
+    # use the smallest suffix which doesn't round up to 1000 of itself, so 999999 is 1M rather than 1000K
+    suffixes = ((1000, 'K'), (1000000, 'M'), (1000000000, 'B'))
+    for divisor, suffix in suffixes:
+        value = round(float(count) / divisor, 1)
+        if value < 1000 or suffix == suffixes[-1][1]:
+            return "%s%s" % (('%.1f' % value).replace('.0', ''), suffix)
+
 @register.filter
 def is_smartobject(obj):
     """
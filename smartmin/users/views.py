@@ -127,6 +127,7 @@ class UserCRUDL(SmartCRUDL):
         default_order = 'username'
         add_button = True
         template_name = "smartmin/users/user_list.html"
+        field_config = { 'group': dict(related=('groups',)) }
         
         def get_context_data(self, **kwargs):
             context = super(UserCRUDL.List, self).get_context_data(**kwargs)
@@ -5,26 +5,79 @@ from django.views.generic.edit import FormMixin, ModelFormMixin, UpdateView, Cre
 from django.views.generic.base import TemplateView, View
 from django.views.generic import DetailView, ListView
 import django.forms.models as model_forms
-from guardian.utils import get_anonymous_user
 from django.utils.http import urlquote
-from django.db.models import Q
+from django.db.models import Q, Min, Max
 from django.db import IntegrityError
 from django.conf import settings
 from django.contrib.auth import REDIRECT_FIELD_NAME
 from django.http import HttpResponseRedirect, HttpResponse
-from guardian.shortcuts import get_objects_for_user, assign
+from guardian.shortcuts import assign
+from guardian.utils import get_anonymous_user
 from django.core.exceptions import ImproperlyConfigured
+from django.db.models.fields import FieldDoesNotExist
 from django import forms
 from django.utils import simplejson
 from django.conf.urls.defaults import patterns, url
-from django.core.urlresolvers import reverse
+from django.core.urlresolvers import reverse, get_script_prefix, get_urlconf, NoReverseMatch
 from django.contrib import messages
-from django.contrib.auth.models import User
-
+from django.core.cache import cache
+from django.core.paginator import Paginator, Page, EmptyPage, PageNotAnInteger
+from django.db import connections
+from django.utils.encoding import smart_str
+
+import base64
+import hashlib
+import logging
+import re
 import string
+import time
+from functools import update_wrapper
 from smartmin.csv_imports.models import ImportTask
+from smartmin.perms import filter_by_object_permission, get_anonymous_permissions
 import widgets
 
+logger = logging.getLogger(__name__)
+
+# reversed urls with a placeholder where their id goes, keyed by url name, script prefix and urlconf
+_url_templates = {}
+
+# stands in for ids when reversing, made of digits so that it matches id patterns such as \d+
+URL_PLACEHOLDER = '9081726354'
+
+# ids which can be substituted into a url reversed with our placeholder
+ASCII_DIGITS = re.compile(r'^[0-9]+$')
+
+def reverse_with_id(name, id):
+    """
+    Reverses the passed in url name with the passed in id as its only argument.  Each name is only reversed
+    once, with a placeholder which is then replaced by the id, as long as the id is a plain number.
+    """
+    id = force_unicode(id)
+
+    # non-ascii ids, digits or not, need quoting, which reverse() does for us
+    if not ASCII_DIGITS.match(id):
+        return reverse(name, args=[id])
+
+    key = (name, get_script_prefix(), get_urlconf() or settings.ROOT_URLCONF)
+    template = _url_templates.get(key, False)
+
+    if template is False:
+        try:
+            template = reverse(name, args=[URL_PLACEHOLDER])
+
+            # only use our template if the placeholder ends up in it exactly once
+            if template.count(URL_PLACEHOLDER) != 1:
+                template = None
+        except NoReverseMatch:
+            template = None
+
+        _url_templates[key] = template
+
+    if template is None:
+        return reverse(name, args=[id])
+
+    return template.replace(URL_PLACEHOLDER, id)
+
 def smart_url(url, id=None):
     """
     URLs that start with @ are reversed, using the passed in arguments.
@@ -35,7 +88,7 @@ def smart_url(url, id=None):
         (args, value) = url.split('@')
 
         if args:
-            return reverse(value, args=[id])
+            return reverse_with_id(value, id)
         else:
             return reverse(value)
     else:
@@ -44,6 +97,57 @@ def smart_url(url, id=None):
         else:
             return url % id
 
+# the field metadata of each model we have looked at, shared by the whole process
+_model_field_metadata = {}
+
+def get_field_metadata(model):
+    """
+    Returns a tuple of a dict of the names of the fields of the passed in model to their verbose names and
+    help text, and the set of field names which can be ordered by.  These are only built once per model.
+    """
+    metadata = _model_field_metadata.get(model)
+
+    if metadata is None:
+        fields = dict()
+        for model_field in reversed(model._meta.fields):
+            fields[model_field.name] = (model_field.verbose_name, model_field.help_text)
+
+        metadata = (fields, frozenset(model._meta.get_all_field_names()))
+        _model_field_metadata[model] = metadata
+
+    return metadata
+
+# the compiled accessor for each field path we have looked up, shared by the whole process
+_field_accessors = {}
+
+def get_field_accessor(field):
+    """
+    Returns a function which looks up the value of the passed in field, which may be a dotted path such as
+    'created_by.username', from an object.  Each attribute along the path is called if it is callable, and
+    the lookup stops at the first empty value.  The path is only parsed once per field.
+    """
+    accessor = _field_accessors.get(field)
+
+    if accessor is None:
+        names = tuple(field.split('.'))
+
+        def accessor(obj):
+            for name in names:
+                obj = getattr(obj, name, None)
+
+                # if it is callable, do so
+                if obj and getattr(obj, '__call__', None):
+                    obj = obj()
+
+                if not obj:
+                    break
+
+            return obj
+
+        _field_accessors[field] = accessor
+
+    return accessor
+
 class SmartView(object):
     fields = None
     exclude = None
@@ -64,6 +168,11 @@ class SmartView(object):
         class.
         """
         self.extra_context = {}
+
+        # permission decisions and objects loaded while checking them, kept for the life of this request
+        self._permission_cache = {}
+        self._object_cache = {}
+
         super(SmartView, self).__init__()
 
     def derive_title(self):
@@ -72,6 +181,13 @@ class SmartView(object):
         """
         return self.title
 
+    def derive_timezone(self):
+        """
+        Returns the name of the timezone dates are shown in on this page, by default the USER_TIME_ZONE
+        setting.  Subclasses may override this to show dates in each user's own timezone.
+        """
+        return getattr(settings, 'USER_TIME_ZONE', None)
+
     @classmethod
     def derive_url_pattern(cls, path, action):
         """
@@ -91,12 +207,11 @@ class SmartView(object):
             return True
         else:
             # first check our anonymous permissions
-            real_anon = get_anonymous_user()
-            has_perm = real_anon.has_perm(self.permission)            
+            has_perm = self.permission in get_anonymous_permissions()
 
             # if not, then check our real permissions
             if not has_perm:
-                has_perm = request.user.has_perm(self.permission)
+                has_perm = self.user_has_perm(self.permission)
 
             # if not, perhaps we have it per object
             if not has_perm:
@@ -123,12 +238,125 @@ class SmartView(object):
         if obj_getter:
             obj = obj_getter()
             if obj:
-                return self.request.user.has_perm(getattr(self, 'permission', None), obj)
+                return self.user_has_perm(getattr(self, 'permission', None), obj)
+
+    def user_has_perm(self, permission, obj=None):
+        """
+        Returns whether our user has the passed in permission, optionally on the passed in object.  Decisions
+        are remembered for the rest of the request.
+        """
+        user = self.request.user
+        key = (user.id, permission, obj.__class__, obj.pk) if obj else (user.id, permission, None, None)
+        if key not in self._permission_cache:
+            self._permission_cache[key] = user.has_perm(permission, obj)
+
+        return self._permission_cache[key]
+
+    def get_object(self, queryset=None):
+        """
+        Returns the object for this view, loading it only once per request.  This means the object loaded
+        when checking object permissions is the same one used as our object.
+        """
+        getter = getattr(super(SmartView, self), 'get_object', None)
+        if not getter:
+            return None
+
+        # objects from custom querysets aren't cached
+        if queryset is not None:
+            return getter(queryset)
+
+        if 'object' not in self._object_cache:
+            self._object_cache['object'] = getter()
+
+        return self._object_cache['object']
+
+    # the phases of our dispatch which are timed when the VIEW_TIMINGS setting is on, and the methods they time
+    TIMED_PHASES = (('permission', 'has_permission'),
+                    ('pre_process', 'pre_process'),
+                    ('queryset', 'get_queryset'),
+                    ('context', 'get_context_data'))
+
+    def count_queries(self):
+        return sum([len(connections[alias].queries) for alias in connections])
+
+    def timed(self, phase, method):
+        """
+        Wraps the passed in method so that the time spent and queries made in it are recorded against the
+        passed in phase.  Calls made while another phase is being timed count towards that phase instead.
+        """
+        def timed_method(*args, **kwargs):
+            if self._timing_phase:
+                return method(*args, **kwargs)
+
+            self._timing_phase = phase
+            start = time.time()
+            queries = self.count_queries()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.timings.append((phase, time.time() - start, self.count_queries() - queries))
+                self._timing_phase = None
+
+        return timed_method
+
+    def dispatch_timed(self, request, *args, **kwargs):
+        """
+        Dispatches the passed in request, timing each phase and counting the queries made in it.  The timings
+        are kept in self.timings and added to the response in a Server-Timing header.  If the request has
+        _timings in its query string, a JSON summary of them is returned instead of the response.
+
+        Template responses are rendered here, so that rendering can be timed too.
+        """
+        self.timings = []
+        self._timing_phase = None
+
+        # we need debug cursors to count queries
+        debug_cursors = dict([(alias, connections[alias].use_debug_cursor) for alias in connections])
+        for alias in connections:
+            connections[alias].use_debug_cursor = True
+
+        for (phase, method) in self.TIMED_PHASES:
+            if hasattr(self, method):
+                setattr(self, method, self.timed(phase, getattr(self, method)))
+
+        try:
+            start = time.time()
+            queries = self.count_queries()
+
+            response = self.dispatch_untimed(request, *args, **kwargs)
+            if getattr(response, 'render', None) and not response.is_rendered:
+                self.timed('render', response.render)()
+
+            self.timings.append(('total', time.time() - start, self.count_queries() - queries))
+        finally:
+            for (phase, method) in self.TIMED_PHASES:
+                self.__dict__.pop(method, None)
+
+            for alias in connections:
+                connections[alias].use_debug_cursor = debug_cursors[alias]
+
+        if '_timings' in request.GET:
+            summary = [dict(phase=phase, time=round(seconds * 1000, 3), queries=queries)
+                       for (phase, seconds, queries) in self.timings]
+            return HttpResponse(simplejson.dumps(summary), content_type='application/json')
+
+        response['Server-Timing'] = ", ".join(['%s;dur=%.3f;desc="%d queries"' % (phase, seconds * 1000, queries)
+                                               for (phase, seconds, queries) in self.timings])
+        return response
 
     def dispatch(self, request, *args, **kwargs):
         """
         Overloaded to check permissions if appropriate
         """
+        if getattr(settings, 'VIEW_TIMINGS', False):
+            return self.dispatch_timed(request, *args, **kwargs)
+
+        return self.dispatch_untimed(request, *args, **kwargs)
+
+    def dispatch_untimed(self, request, *args, **kwargs):
+        """
+        Checks our permissions and pre processes the request before dispatching it as usual
+        """
         def wrapper(request, *args, **kwargs):
             if not self.has_permission(request, *args, **kwargs):
                 path = urlquote(request.get_full_path())
@@ -159,24 +387,7 @@ class SmartView(object):
         Looks for a field's value from the passed in obj.  Note that this will strip
         leading attributes to deal with subelements if possible
         """
-        curr_field = field
-        rest = None
-
-        if field.find('.') >= 0:
-            curr_field = field.split('.')[0]
-            rest = '.'.join(field.split('.')[1:])
-
-        # next up is the object itself
-        obj_field = getattr(obj, curr_field, None)
-
-        # if it is callable, do so
-        if obj_field and getattr(obj_field, '__call__', None):
-            obj_field = obj_field()
-
-        if obj_field and rest:
-            return self.lookup_obj_attribute(obj_field, rest)
-        else:
-            return obj_field
+        return get_field_accessor(field)(obj)
 
     def lookup_field_value(self, context, obj, field):
         """
@@ -197,6 +408,26 @@ class SmartView(object):
 
         return self.lookup_obj_attribute(obj, field)
 
+    def lookup_field_values(self, context, objects, field):
+        """
+        Looks up the values of the passed in field for each of the passed in objects, such as a column of a
+        page of our list.  The view's get_ method or the field's accessor is only found once for the whole
+        column, unless our subclass changes how single values are looked up.
+        """
+        view_class = self.__class__
+        if view_class.lookup_field_value.im_func is not SmartView.lookup_field_value.im_func or \
+           view_class.lookup_obj_attribute.im_func is not SmartView.lookup_obj_attribute.im_func:
+            return [self.lookup_field_value(context, obj, field) for obj in objects]
+
+        lookup = None
+        if field.find('.') == -1:
+            lookup = getattr(self, 'get_%s' % field, None)
+
+        if not lookup:
+            lookup = get_field_accessor(field)
+
+        return [lookup(obj) for obj in objects]
+
     def lookup_field_label(self, context, field, default=None):
         """
         Figures out what the field label should be for the passed in field name.
@@ -221,9 +452,9 @@ class SmartView(object):
 
         # check our model
         else:
-            for model_field in self.model._meta.fields:
-                if model_field.name == field:
-                    return model_field.verbose_name.title()
+            fields = get_field_metadata(self.model)[0]
+            if field in fields:
+                return fields[field][0].title()
 
         # otherwise, derive it from our field name
         if label is None:
@@ -246,11 +477,10 @@ class SmartView(object):
             help = default
 
         # try to see if there is a description on our model
-        elif hasattr(self, 'model'):
-            for model_field in self.model._meta.fields:
-                if model_field.name == field:
-                    help = model_field.help_text
-                    break
+        elif getattr(self, 'model', None):
+            fields = get_field_metadata(self.model)[0]
+            if field in fields:
+                help = fields[field][1]
 
         return help
 
@@ -352,6 +582,7 @@ class SmartView(object):
         context['field_config'] = self.field_config
 
         context['title'] = self.derive_title()
+        context['user_timezone'] = self.derive_timezone()
 
         # and any extra context the user specified
         context.update(self.extra_context)
@@ -479,6 +710,103 @@ class SmartDeleteView(SmartView, DetailView, ProcessFormView):
         context['cancel_url'] = self.get_cancel_url()
         return context
 
+class CursorPage(object):
+    """
+    A page of results built by seeking from a cursor rather than by counting off rows.  It quacks
+    enough like Django's Page to be used as page_obj, but has no idea how many results there are in
+    total, only whether there are more on either side of it.
+    """
+    def __init__(self, object_list, next_cursor=None, previous_cursor=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+class SmartPage(Page):
+    """
+    A page of a paginator whose count may be off, which knows whether there is a next page from having
+    fetched one more result than it shows rather than from that count.
+    """
+    def __init__(self, object_list, number, paginator, more):
+        super(SmartPage, self).__init__(object_list, number, paginator)
+        self.more = more
+
+    def has_next(self):
+        return self.more
+
+    def start_index(self):
+        if not self.object_list:
+            return 0
+        return (self.number - 1) * self.paginator.per_page + 1
+
+    def end_index(self):
+        return self.start_index() + len(self.object_list) - 1 if self.object_list else 0
+
+class SmartPaginator(Paginator):
+    """
+    A paginator which asks the passed in counter for its count, returning a tuple of the count and
+    whether it is an estimate, letting our views decide how hard to work at counting.
+
+    Unless its count is exact, pages past the number our count gives us can still be asked for, each page
+    fetching one more result than it shows to know whether there is another after it.
+    """
+    def __init__(self, object_list, per_page, orphans=0, allow_empty_first_page=True, counter=None, exact=True):
+        super(SmartPaginator, self).__init__(object_list, per_page, orphans, allow_empty_first_page)
+        self.counter = counter
+        self.exact = exact
+        self.count_estimated = False
+
+    def _get_count(self):
+        if self._count is None and self.counter:
+            (self._count, self.count_estimated) = self.counter(self.object_list)
+
+        return super(SmartPaginator, self)._get_count()
+    count = property(_get_count)
+
+    def is_exact(self):
+        """
+        Whether our count is exact, cached counts may be out of date and estimates can be off either way
+        """
+        return self.exact
+
+    def validate_number(self, number):
+        if self.is_exact():
+            return super(SmartPaginator, self).validate_number(number)
+
+        try:
+            number = int(number)
+        except (TypeError, ValueError):
+            raise PageNotAnInteger('That page number is not an integer')
+        if number < 1:
+            raise EmptyPage('That page number is less than 1')
+        return number
+
+    def page(self, number):
+        if self.is_exact():
+            return super(SmartPaginator, self).page(number)
+
+        number = self.validate_number(number)
+        bottom = (number - 1) * self.per_page
+        objects = list(self.object_list[bottom:bottom + self.per_page + 1])
+        if not objects and number > 1:
+            raise EmptyPage('That page contains no results')
+
+        return SmartPage(objects[:self.per_page], number, self, len(objects) > self.per_page)
+
 class SmartListView(SmartView, ListView):
     default_template = 'smartmin/list.html'
 
@@ -491,6 +819,28 @@ class SmartListView(SmartView, ListView):
     field_config = { 'is_active': dict(label=''), }
     default_order = None
 
+    # whether to paginate by seeking from an opaque _cursor parameter instead of page numbers
+    cursor_paginate = False
+
+    # how we count our results when paginating, one of 'exact', 'cached' or 'estimated'
+    count_strategy = 'exact'
+
+    # how many seconds cached counts are kept for
+    count_cache_timeout = 60
+
+    # estimated counts are exact below this number of results, and how many rows are sampled above it
+    count_estimate_threshold = 1000
+
+    # how many ranges of ids, spread across the table, those rows are sampled from
+    count_estimate_ranges = 10
+
+    # relations to select_related and prefetch_related, by default these are derived from our fields
+    select_related = None
+    prefetch_related = None
+
+    # the relations derived from our fields for this request, derived once as we build our queryset
+    related_lookups = None
+
     list_permission = None
 
     @classmethod
@@ -540,12 +890,33 @@ class SmartListView(SmartView, ListView):
         Returns whether the passed in field is sortable or not, by default all 'raw' fields, that
         is fields that are part of the model are sortable.
         """
-        try:
-            self.model._meta.get_field_by_name(field)
-            return True
-        except:
-            # that field doesn't exist, so not sortable
-            return False
+        return field in get_field_metadata(self.model)[1]
+
+    def lookup_table_rows(self, context, objects, fields):
+        """
+        Builds the rows of our list table in one pass over the passed in objects.  Each row is a dict of
+        the object and its cells, each cell a dict of the field, its value, its class and its link if any.
+
+        Values, classes and links are still looked up through lookup_field_values(), lookup_field_class()
+        and lookup_field_link() so subclasses can change them as before.
+        """
+        objects = list(objects)
+        link_fields = context.get('link_fields', None) or ()
+
+        columns = []
+        for field in fields:
+            values = self.lookup_field_values(context, objects, field)
+            default_class = "field_" + field
+            link = field in link_fields
+
+            cells = []
+            for (obj, value) in zip(objects, values):
+                cells.append(dict(field=field, value=value,
+                                  css=self.lookup_field_class(field, obj, default_class),
+                                  link=self.lookup_field_link(context, field, obj) if link else None))
+            columns.append(cells)
+
+        return [dict(obj=obj, cells=[column[i] for column in columns]) for (i, obj) in enumerate(objects)]
 
     def get_context_data(self, **kwargs):
         """
@@ -568,6 +939,13 @@ class SmartListView(SmartView, ListView):
         context['url_params'] = url_params
         context['pjax'] = self.pjax
 
+        # cursors are only valid for the ordering they were built with, so our cursor links keep it
+        if self.cursor_paginate:
+            cursor_params = url_params
+            if '_order' in self.request.REQUEST:
+                cursor_params += "_order=%s&" % self.request.REQUEST['_order']
+            context['cursor_params'] = cursor_params
+
         # our search term if any
         if 'search' in self.request.REQUEST:
             context['search'] = self.request.REQUEST['search']
@@ -604,9 +982,110 @@ class SmartListView(SmartView, ListView):
 
             queryset = queryset.filter(query)
 
+        # select and prefetch any relations our fields walk, so we don't query for them row by row
+        self.related_lookups = None
+        if self.select_related is None or self.prefetch_related is None:
+            self.related_lookups = self.derive_related_lookups()
+
+        select_related = self.derive_select_related()
+        if select_related:
+            queryset = queryset.select_related(*select_related)
+
+        prefetch_related = self.derive_prefetch_related()
+        if prefetch_related:
+            queryset = queryset.prefetch_related(*prefetch_related)
+
         # return our queryset
         return queryset
 
+    def lookup_relation(self, model, name):
+        """
+        Looks up the relation with the passed in attribute name on the passed in model, returning a tuple
+        of the model it leads to and whether it can be selected, or (None, False) if it isn't a relation.
+        """
+        try:
+            (field, field_model, direct, m2m) = model._meta.get_field_by_name(name)
+            if direct:
+                if field.rel:
+                    return field.rel.to, not m2m
+                return None, False
+        except FieldDoesNotExist:
+            pass
+
+        # reverse relations are found by their accessor name, only reverse one to ones can be selected
+        for related in model._meta.get_all_related_objects() + model._meta.get_all_related_many_to_many_objects():
+            if related.get_accessor_name() == name:
+                return related.model, isinstance(related.field, models.OneToOneField)
+
+        return None, False
+
+    def derive_related_lookups(self):
+        """
+        Works out which relations will be walked when displaying our fields, returning a tuple of the lookups
+        that can be selected and those that need to be prefetched.
+
+        Fields with a get_ method on the view are skipped, as we can't know what they do, but their field_config
+        can give the lookups they use as 'related', ie: field_config = { 'group': dict(related=('groups',)) }
+        """
+        # this is called while building our queryset, before our object list exists, so views deriving their
+        # fields from it can't tell us their fields yet, we only look at the ones they declare
+        try:
+            fields = self.derive_fields()
+        except AttributeError:
+            if hasattr(self, 'object_list'):
+                raise
+            fields = self.fields or ()
+
+        field_config = self.derive_field_config()
+
+        paths = []
+        for field in fields:
+            if field in field_config and 'related' in field_config[field]:
+                paths += field_config[field]['related']
+            elif field.find('.') >= 0 or not getattr(self, 'get_%s' % field, None):
+                paths.append(field.replace('.', '__'))
+
+        selects = []
+        prefetches = []
+        for path in paths:
+            model = self.model
+            lookup = []
+            selectable = True
+
+            for name in path.split('__'):
+                (model, can_select) = self.lookup_relation(model, name)
+                if not model:
+                    break
+
+                lookup.append(name)
+                selectable = selectable and can_select
+
+            if lookup:
+                lookup = '__'.join(lookup)
+                related = selects if selectable else prefetches
+                if lookup not in related:
+                    related.append(lookup)
+
+        return selects, prefetches
+
+    def derive_select_related(self):
+        """
+        Returns the relations to select_related in our queryset, by default derived from our fields
+        """
+        if self.select_related is not None:
+            return self.select_related
+
+        return (self.related_lookups or self.derive_related_lookups())[0]
+
+    def derive_prefetch_related(self):
+        """
+        Returns the relations to prefetch_related in our queryset, by default derived from our fields
+        """
+        if self.prefetch_related is not None:
+            return self.prefetch_related
+
+        return (self.related_lookups or self.derive_related_lookups())[1]
+
     def get_queryset(self, **kwargs):
         """
         Gets our queryset.  This takes care of filtering if there are any
@@ -618,15 +1097,24 @@ class SmartListView(SmartView, ListView):
         # if our list should be filtered by a permission as well, do so
         if self.list_permission:
             # only filter if this user doesn't have a global permission
-            if not self.request.user.has_perm(self.list_permission):
-                user = self.request.user
-                # guardian only behaves with model users
-                if settings.ANONYMOUS_USER_ID and user.is_anonymous():
-                    user = User.objects.get(pk=settings.ANONYMOUS_USER_ID)
-                queryset = queryset.filter(id__in=get_objects_for_user(user, self.list_permission))
+            if not self.user_has_perm(self.list_permission):
+                queryset = self.filter_list_permission(queryset)
 
         return self.order_queryset(queryset)
 
+    def filter_list_permission(self, queryset):
+        """
+        Filters the passed in queryset to only those objects our user has been granted our list_permission
+        on.  By default this uses a cached set of object ids which is invalidated as permissions change.
+        """
+        user_id = self.request.user.id
+
+        # guardian stores anonymous permissions against its own anonymous user
+        if settings.ANONYMOUS_USER_ID and self.request.user.is_anonymous():
+            user_id = settings.ANONYMOUS_USER_ID
+
+        return filter_by_object_permission(queryset, user_id, self.list_permission)
+
     def derive_ordering(self):
         """
         Returns what field should be used for ordering (using a prepended '-' to indicate descending sort).
@@ -655,6 +1143,305 @@ class SmartListView(SmartView, ListView):
 
         return queryset
 
+    def derive_cursor_ordering(self, queryset):
+        """
+        Returns the list of fields used to seek through our results when paginating by cursor.  This is
+        our normal ordering with the primary key tacked on the end so every row has a unique position.
+
+        Note that the fields used here should not be nullable, as NULLs can't be seeked past.  Orderings asked for
+        with the _order parameter which can't be seeked through are ignored in favour of our default ordering.
+        """
+        order = self.derive_ordering()
+        if order and '_order' in self.request.REQUEST:
+            ordering = self.complete_cursor_ordering(queryset, order)
+            if ordering and self.can_seek(queryset.model, ordering):
+                return ordering
+
+            # our queryset is already ordered by what was asked for, so we can't fall back to its ordering
+            order = self.default_order or queryset.model._meta.ordering
+
+        elif not order:
+            order = queryset.query.order_by or queryset.model._meta.ordering
+
+        ordering = self.complete_cursor_ordering(queryset, order)
+        if ordering is None:
+            raise ImproperlyConfigured("Random ordering can't be used with cursor pagination")
+
+        return ordering
+
+    def complete_cursor_ordering(self, queryset, order):
+        """
+        Returns the passed in order with the primary key tacked on the end, if it doesn't already include it,
+        or None if it is a random ordering.
+        """
+        if isinstance(order, (str, unicode)):
+            order = (order,)
+
+        pk_names = ('pk', queryset.model._meta.pk.name)
+        ordering = []
+        for field in order:
+            if field == '?':
+                return None
+
+            ordering.append(field)
+            if field.lstrip('-') in pk_names:
+                return ordering
+
+        ordering.append('pk')
+        return ordering
+
+    def can_seek(self, model, ordering):
+        """
+        Returns whether we can seek through results with the passed in ordering, that is whether every field
+        in it is a column of the passed in model which can't be null, as NULLs can't be seeked past.
+        """
+        for field in ordering:
+            name = field.lstrip('-')
+            if name == 'pk':
+                continue
+
+            try:
+                if model._meta.get_field(name).null:
+                    return False
+            except FieldDoesNotExist:
+                return False
+
+        return True
+
+    def lookup_cursor_value(self, obj, field):
+        """
+        Looks up the value of the passed in ordering field, which may span relations, for the passed in object.
+        """
+        value = obj
+        for name in field.lstrip('-').split('__'):
+            value = getattr(value, name)
+
+        if isinstance(value, models.Model):
+            value = value.pk
+
+        return value
+
+    def encode_cursor(self, obj, ordering, backwards=False):
+        """
+        Encodes the position of the passed in object within our ordering as an opaque, url safe, string.
+        """
+        values = [self.lookup_cursor_value(obj, field) for field in ordering]
+        cursor = simplejson.dumps(dict(o=ordering, v=values, b=backwards), default=unicode)
+        return base64.urlsafe_b64encode(cursor).rstrip('=')
+
+    def decode_cursor(self, cursor, ordering):
+        """
+        Decodes a cursor created by encode_cursor, returning a tuple of the ordering values and whether
+        we are seeking backwards.  Returns None if the cursor is invalid or was built for a different ordering.
+        """
+        try:
+            cursor = str(cursor)
+            decoded = simplejson.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+            if decoded['o'] != list(ordering) or len(decoded['v']) != len(ordering):
+                return None
+            return decoded['v'], bool(decoded['b'])
+        except (TypeError, ValueError, KeyError, UnicodeError):
+            return None
+
+    def seek_queryset(self, queryset, ordering, values):
+        """
+        Filters the passed in queryset to only those rows which come after the passed in values in our
+        ordering.  This is the expanded form of (col1, col2, pk) > (val1, val2, pk_val), respecting the
+        direction of each column, with a leading range on the first column so an index can be used.
+        """
+        def compare(field, value, inclusive=False):
+            lookup = 'lt' if field.startswith('-') else 'gt'
+            if inclusive:
+                lookup += 'e'
+            return Q(**{'%s__%s' % (field.lstrip('-'), lookup): value})
+
+        query = None
+        for index, field in enumerate(ordering):
+            term = compare(field, values[index])
+            for prev_field, prev_value in zip(ordering[:index], values[:index]):
+                term &= Q(**{prev_field.lstrip('-'): prev_value})
+            query = term if query is None else query | term
+
+        if len(ordering) > 1:
+            query = compare(ordering[0], values[0], inclusive=True) & query
+
+        return queryset.filter(query)
+
+    def derive_count_strategy(self):
+        """
+        Returns how the results for this request should be counted, by default our count_strategy.
+        """
+        return self.count_strategy
+
+    def count_queryset(self, queryset):
+        """
+        Counts the passed in queryset using our count strategy, returning a tuple of the count and
+        whether it is an estimate.
+        """
+        strategy = self.derive_count_strategy()
+
+        if strategy == 'exact':
+            return queryset.count(), False
+        elif strategy == 'cached':
+            return self.cached_count(queryset), False
+        elif strategy == 'estimated':
+            return self.estimated_count(queryset)
+        else:
+            raise ImproperlyConfigured("Unknown count strategy '%s', must be 'exact', 'cached' or 'estimated'" % strategy)
+
+    def cached_count(self, queryset):
+        """
+        Returns the count for the passed in queryset, caching it for count_cache_timeout seconds.  We key our
+        cache by the SQL of the query, so the search, filters and permissions applied are all accounted for.
+        """
+        sql, params = queryset.query.sql_with_params()
+        key = "smartmin:count:%s" % hashlib.md5(smart_str(u"%s:%s:%r" % (queryset.db, sql, params))).hexdigest()
+
+        count = cache.get(key)
+        if count is None:
+            count = queryset.count()
+            cache.set(key, count, self.count_cache_timeout)
+
+        return count
+
+    def estimated_count(self, queryset):
+        """
+        Returns an estimated count for the passed in queryset, and whether it is actually an estimate.
+
+        Small result sets are counted exactly, as that is cheap.  Beyond that, on PostgreSQL we ask the query
+        planner for its estimate, otherwise we extrapolate from how many of a sample of rows match our query.
+        """
+        threshold = self.count_estimate_threshold
+
+        # Django counts sliced querysets in full, so we fetch up to our threshold worth of ids instead
+        count = len(queryset.values_list('pk', flat=True)[:threshold])
+        if count < threshold:
+            return count, False
+
+        connection = connections[queryset.db]
+        if connection.vendor == 'postgresql':
+            sql, params = queryset.query.sql_with_params()
+            cursor = connection.cursor()
+            cursor.execute("EXPLAIN %s" % sql, params)
+            match = re.search(r'rows=(\d+)', cursor.fetchone()[0])
+            if match:
+                return max(int(match.group(1)), threshold), True
+
+        # we can only sample ranges of integer primary keys, anything else is counted exactly
+        pk = queryset.model._meta.pk
+        if not isinstance(pk, (models.AutoField, models.IntegerField)):
+            return queryset.count(), False
+
+        manager = queryset.model._default_manager.db_manager(queryset.db)
+        bounds = manager.aggregate(low=Min(pk.name), high=Max(pk.name))
+        (low, high) = (bounds['low'], bounds['high'])
+        span = high - low + 1
+
+        # sample rows from ranges spread evenly across our table, seeing how many of them our query matches,
+        # and how densely packed the ids in each range are
+        ranges = min(self.count_estimate_ranges, span)
+        per_range = max(threshold / ranges, 1)
+        sampled = matched = covered = 0
+
+        for i in range(ranges):
+            (start, end) = (low + span * i / ranges, low + span * (i + 1) / ranges)
+            pks = list(manager.filter(pk__gte=start, pk__lt=end).order_by('pk')
+                              .values_list('pk', flat=True)[:per_range])
+            if not pks:
+                covered += end - start
+                continue
+
+            # if we didn't get a full sample, we have seen every row in this range
+            last = pks[-1] if len(pks) == per_range else end - 1
+
+            sampled += len(pks)
+            covered += last - start + 1
+            matched += queryset.filter(pk__gte=start, pk__lte=last).count()
+
+        # scale by the database's estimate of the size of our table, or failing that our own from our sample
+        total = self.estimate_table_count(queryset.model, queryset.db)
+        if total is None:
+            total = sampled * span / covered
+
+        return max(total * matched / max(sampled, 1), threshold), True
+
+    def estimate_table_count(self, model, db):
+        """
+        Returns the database's own estimate of how many rows the table of the passed in model has, which
+        PostgreSQL and MySQL keep up to date without counting.  Returns None for other databases.
+        """
+        connection = connections[db]
+        table = model._meta.db_table
+
+        if connection.vendor == 'postgresql':
+            sql = "SELECT reltuples FROM pg_class WHERE relname = %s"
+        elif connection.vendor == 'mysql':
+            sql = "SELECT table_rows FROM information_schema.tables WHERE table_schema = DATABASE() AND table_name = %s"
+        else:
+            return None
+
+        cursor = connection.cursor()
+        cursor.execute(sql, [table])
+        row = cursor.fetchone()
+
+        # tables which have never been analyzed have no estimate
+        if not row or not row[0] or row[0] < 0:
+            return None
+
+        return int(row[0])
+
+    def get_paginator(self, queryset, per_page, orphans=0, allow_empty_first_page=True):
+        """
+        Overloaded to have our paginator count using our count strategy.
+        """
+        return SmartPaginator(queryset, per_page, orphans=orphans, allow_empty_first_page=allow_empty_first_page,
+                              counter=self.count_queryset, exact=self.derive_count_strategy() == 'exact')
+
+    def paginate_queryset(self, queryset, page_size):
+        """
+        Overloaded to paginate by cursor if so configured.  Each page is found by seeking past the last row of
+        the previous one, so no page needs an OFFSET or a COUNT(*) and deep pages are as cheap as the first.
+        """
+        if not self.cursor_paginate:
+            return super(SmartListView, self).paginate_queryset(queryset, page_size)
+
+        ordering = self.derive_cursor_ordering(queryset)
+        reverse_ordering = [field[1:] if field.startswith('-') else '-' + field for field in ordering]
+
+        cursor = self.decode_cursor(self.request.REQUEST.get('_cursor', None), ordering)
+        backwards = False
+
+        if cursor:
+            values, backwards = cursor
+            if backwards:
+                queryset = self.seek_queryset(queryset, reverse_ordering, values)
+            else:
+                queryset = self.seek_queryset(queryset, ordering, values)
+
+        queryset = queryset.order_by(*(reverse_ordering if backwards else ordering))
+
+        # fetch one more than we need so we know whether there is anything beyond this page
+        objects = list(queryset[:page_size + 1])
+        has_more = len(objects) > page_size
+        objects = objects[:page_size]
+
+        if backwards:
+            objects.reverse()
+            has_next, has_previous = True, has_more
+        else:
+            has_next, has_previous = has_more, cursor is not None
+
+        next_cursor = None
+        previous_cursor = None
+        if objects:
+            if has_next:
+                next_cursor = self.encode_cursor(objects[-1], ordering)
+            if has_previous:
+                previous_cursor = self.encode_cursor(objects[0], ordering, backwards=True)
+
+        page = CursorPage(objects, next_cursor, previous_cursor)
+        return (None, page, objects, page.has_other_pages())
+
     def derive_fields(self):
         """
         Derives our fields.
@@ -663,8 +1450,11 @@ class SmartListView(SmartView, ListView):
             return self.fields
 
         else:
+            # our fields are derived before our object list exists when we build our queryset
+            model = self.object_list.model if hasattr(self, 'object_list') else self.model
+
             fields = []
-            for field in self.object_list.model._meta.fields:
+            for field in model._meta.fields:
                 if field.name != 'id':
                     fields.append(field.name)
             return fields
@@ -683,6 +1473,19 @@ class SmartListView(SmartView, ListView):
             return ''
 
 class SmartCsvView(SmartListView):
+    # exports aren't paginated, every row is written
+    paginate_by = None
+
+    # whether rows are streamed to the client as they are generated rather than the whole file being built first
+    streaming = False
+
+    # how many objects are loaded and written at a time when streaming
+    chunk_size = 1000
+
+    # whether exports are queued and written to a file by a background task rather than within the request,
+    # this requires smartmin.csv_exports to be installed.  The task runs the view with a rebuilt request which
+    # has no session and only the META keys in ExportTask.EXPORT_META
+    background_export = False
 
     def derive_filename(self):
         filename = getattr(self, 'filename', None)
@@ -690,30 +1493,226 @@ class SmartCsvView(SmartListView):
             filename = "%s.csv" % self.model._meta.verbose_name.lower()
         return filename
 
-    def render_to_response(self, context, **response_kwargs):
+    def derive_header(self, fields):
+        """
+        Returns our header row for the passed in fields, encoded as UTF-8
+        """
+        return [unicode(self.lookup_field_label(dict(), field)).encode("utf-8") for field in fields]
+
+    def derive_row(self, obj, fields):
+        """
+        Returns the row of values for the passed in object and fields, encoded as UTF-8
+        """
+        return [unicode(self.lookup_field_value(dict(), obj, field)).encode("utf-8") for field in fields]
+
+    def iterate_pages(self, queryset, lookups=None):
+        """
+        Pages through the passed in queryset chunk_size rows at a time, yielding each page as a list of objects,
+        or of tuples of the passed in values_list() lookups.
+
+        Database drivers fetch the whole result of a query even when it is read with iterator(), so instead each
+        page is its own query.  Where our ordering allows, each page seeks past the last row of the one before,
+        otherwise pages are read by offset.  Any prefetch_related lookups are applied to each page in turn.
+        """
+        try:
+            ordering = self.derive_cursor_ordering(queryset)
+            seekable = self.can_seek(queryset.model, ordering)
+            queryset = queryset.order_by(*ordering)
+        except ImproperlyConfigured:
+            (ordering, seekable) = ([], False)
+
+        # we read our ordering values along with our lookups, so we know where each page ends
+        if lookups is not None:
+            queryset = queryset.values_list(*(list(lookups) + [field.lstrip('-') for field in ordering]))
+
+        size = self.chunk_size
+        (offset, last) = (0, None)
+        while True:
+            if not seekable:
+                page = list(queryset[offset:offset + size])
+            elif last is None:
+                page = list(queryset[:size])
+            else:
+                page = list(self.seek_queryset(queryset, ordering, last)[:size])
+
+            if not page:
+                break
+
+            if lookups is None:
+                last = [self.lookup_cursor_value(page[-1], field) for field in ordering]
+                yield page
+            else:
+                last = list(page[-1][len(lookups):])
+                yield [row[:len(lookups)] for row in page]
+
+            if len(page) < size:
+                break
+
+            offset += size
+
+    def iterate_objects(self):
+        """
+        Iterates our object list in chunks of chunk_size objects, each read with its own query, so our memory
+        use stays flat no matter how many rows there are.
+        """
+        return self.iterate_pages(self.object_list)
+
+    def derive_value_lookups(self, fields):
+        """
+        Maps our fields onto values_list() lookups, so rows can be read straight from the database without
+        building model instances.  Returns None if any field needs the object itself, that is if it has a get_
+        method on the view or is a method, property or relation on the model rather than a plain column.
+        """
+        # views which change how values are looked up need real objects
+        view_class = self.__class__
+        if view_class.lookup_field_value.im_func is not SmartView.lookup_field_value.im_func or \
+           view_class.lookup_obj_attribute.im_func is not SmartView.lookup_obj_attribute.im_func:
+            return None
+
+        lookups = []
+        for field in fields:
+            if field.find('.') == -1 and getattr(self, 'get_%s' % field, None):
+                return None
+
+            # subfields must be reached through single valued relations
+            model = self.model
+            names = field.split('.')
+            for name in names[:-1]:
+                (model, selectable) = self.lookup_relation(model, name)
+                if not model or not selectable:
+                    return None
+
+            try:
+                (model_field, field_model, direct, m2m) = model._meta.get_field_by_name(names[-1])
+            except FieldDoesNotExist:
+                return None
+
+            # relations display as their related object, so those need instances too
+            if not direct or m2m or model_field.rel:
+                return None
+
+            lookups.append('__'.join(names))
+
+        return lookups
+
+    def iterate_rows(self, fields):
+        """
+        Generates the rows for our CSV in chunks of at most chunk_size rows.  When every field is a plain
+        column, rows are read with values_list(), otherwise each object is loaded and its fields looked up.
+        """
+        lookups = self.derive_value_lookups(fields)
+
+        if lookups is None:
+            for chunk in self.iterate_objects():
+                yield [self.derive_row(obj, fields) for obj in chunk]
+
+        else:
+            for chunk in self.iterate_pages(self.object_list.prefetch_related(None), lookups):
+                yield [[unicode(value).encode("utf-8") for value in row] for row in chunk]
+
+    def stream_csv(self, fields):
+        """
+        Generates our CSV a chunk of rows at a time
+        """
         import csv
+        import StringIO
 
-        # Create the HttpResponse object with the appropriate CSV header.
-        response = HttpResponse(mimetype='text/csv; charset=utf-8')
-        response['Content-Disposition'] = 'attachment; filename=%s' % self.derive_filename()
+        buffer = StringIO.StringIO()
+        writer = csv.writer(buffer, quoting=csv.QUOTE_ALL)
+        writer.writerow(self.derive_header(fields))
+
+        for chunk in self.iterate_rows(fields):
+            writer.writerows(chunk)
+
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+        yield buffer.getvalue()
+
+    def queue_export(self):
+        """
+        Creates an export task for this request and queues it, redirecting the user to a page where they
+        can follow its progress.
+        """
+        from smartmin.csv_exports.models import ExportTask
+
+        user = self.request.user
+        if not user.is_authenticated():
+            user = get_anonymous_user()
+
+        # the parts of our request's environment our task rebuilds its request with
+        meta = dict((key, self.request.META[key]) for key in ExportTask.EXPORT_META if key in self.request.META)
+
+        task = ExportTask.objects.create(model_class="%s.%s" % (self.model.__module__, self.model.__name__),
+                                         path=self.request.path_info, export_params=self.request.GET.urlencode(),
+                                         export_meta=simplejson.dumps(meta),
+                                         created_by=user, modified_by=user)
+        task.start()
+
+        return HttpResponseRedirect(reverse('csv_exports.exporttask_read', args=[task.pk]))
+
+    def export_csv(self, task, fields):
+        """
+        Writes our CSV to the file of the passed in export task a chunk of rows at a time, updating the
+        task's progress as we go.
+        """
+        import csv
+        import tempfile
+        from uuid import uuid4
+        from django.core.files import File
+
+        total = self.object_list.count()
+        written = 0
+
+        with tempfile.NamedTemporaryFile() as temp:
+            writer = csv.writer(temp, quoting=csv.QUOTE_ALL)
+            writer.writerow(self.derive_header(fields))
+
+            for chunk in self.iterate_rows(fields):
+                writer.writerows(chunk)
+                written += len(chunk)
+                task.set_progress(written * 100 / total if total else 100)
+
+            # exports are served from our media directory, so give them a name nobody can guess
+            temp.flush()
+            task.csv_file.save("%s.csv" % uuid4().hex, File(temp), save=False)
+
+        task.set_progress(100)
+        task.save()
+
+        return HttpResponse("%d record(s) exported." % written)
+
+    def render_to_response(self, context, **response_kwargs):
+        import csv
 
-        writer = csv.writer(response, quoting=csv.QUOTE_ALL)
-        
         fields = self.derive_fields()
 
-        # build up our header row
-        header = []
-        for field in fields:
-            header.append(unicode(self.lookup_field_label(dict(), field)))
-        writer.writerow([s.encode("utf-8") for s in header])
+        # we are running in a background export, write to its file
+        task = getattr(self.request, 'export_task', None)
+        if task:
+            return self.export_csv(task, fields)
 
-        # then our actual values
-        for obj in self.object_list:
-            row = []
-            for field in fields:
-                row.append(unicode(self.lookup_field_value(dict(), obj, field)))
-            writer.writerow([s.encode("utf-8") for s in row])
+        if self.background_export:
+            return self.queue_export()
 
+        # streaming responses are written as they are read, note that any middleware which reads the
+        # response content, such as GZipMiddleware, will end up building the whole file anyways
+        if self.streaming:
+            response = HttpResponse(self.stream_csv(fields), mimetype='text/csv; charset=utf-8')
+
+        else:
+            # Create the HttpResponse object with the appropriate CSV header.
+            response = HttpResponse(mimetype='text/csv; charset=utf-8')
+
+            writer = csv.writer(response, quoting=csv.QUOTE_ALL)
+            writer.writerow(self.derive_header(fields))
+
+            # then our actual values
+            for chunk in self.iterate_rows(fields):
+                writer.writerows(chunk)
+
+        response['Content-Disposition'] = 'attachment; filename=%s' % self.derive_filename()
         return response
     
 class SmartFormMixin(object):
@@ -1164,7 +2163,7 @@ class SmartCreateView(SmartModelFormView, CreateView):
 class SmartCSVImportView(SmartCreateView):
     success_url = 'id@csv_imports.importtask_read'
 
-    fields = ('csv_file',)
+    fields = ('csv_file', 'validate_only')
 
     def derive_title(self):
         return "Import %s" % self.crudl.model._meta.verbose_name_plural.title()
@@ -1184,6 +2183,19 @@ class SmartCSVImportView(SmartCreateView):
 
         return task
 
+# the URL patterns of every CRUDL we have built, and how long building each CRUDL's URLs and views has taken,
+# these are shared by the whole process
+_crudl_urlpatterns = {}
+_crudl_timings = {}
+
+def crudl_timing_report():
+    """
+    Returns a report of how long building the URL patterns and views of each CRUDL has taken in this process,
+    slowest first.
+    """
+    timings = sorted(_crudl_timings.items(), key=lambda timing: timing[1], reverse=True)
+    return "\n".join(["%8.2fms  %s" % (seconds * 1000, name) for (name, seconds) in timings])
+
 class SmartCRUDL(object):
     actions = ('create', 'read', 'update', 'delete', 'list')
     model_name = None
@@ -1193,6 +2205,10 @@ class SmartCRUDL(object):
     
     permissions = True
 
+    # the view classes we build on for actions which don't have their own
+    default_views = dict(create=SmartCreateView, read=SmartReadView, update=SmartUpdateView,
+                         delete=SmartDeleteView, list=SmartListView, csv_import=SmartCSVImportView)
+
     def __init__(self, model=None, path=None, actions=None):
         # set our model if passed in
         if model:
@@ -1223,6 +2239,10 @@ class SmartCRUDL(object):
         if actions:
             self.actions = actions
 
+        # the views we have built, by action
+        self._views = dict()
+        self._view_functions = dict()
+
     def permission_for_action(self, action):
         """
         Returns the permission to use for the passed in action
@@ -1241,9 +2261,36 @@ class SmartCRUDL(object):
         """
         return "%s.%s_%s" % (self.module_name.lower(), self.model_name.lower(), action)        
 
+    def record_timing(self, seconds, built):
+        name = "%s.%s" % (self.__class__.__module__, self.__class__.__name__)
+        _crudl_timings[name] = _crudl_timings.get(name, 0) + seconds
+        logger.debug("Built %s for %s in %.2fms", built, name, seconds * 1000)
+
+    def base_view_for_action(self, action):
+        """
+        Returns the class the view for the passed in action is built from, without building it
+        """
+        class_name = "".join([word.capitalize() for word in action.split("_")])
+        view = getattr(self, class_name, None) or self.default_views.get(action)
+
+        if not view:
+            # couldn't find a view?  blow up
+            raise Exception("No view found for action: %s" % action)
+
+        return view
+
     def view_for_action(self, action):
         """
-        Returns the appropriate view class for the passed in action
+        Returns the appropriate view class for the passed in action, this is only built once
+        """
+        if action not in self._views:
+            self._views[action] = self.build_view_for_action(action)
+
+        return self._views[action]
+
+    def build_view_for_action(self, action):
+        """
+        Builds the view class for the passed in action
         """
         # this turns replace_foo into ReplaceFoo and read into Read
         class_name = "".join([word.capitalize() for word in action.split("_")])
@@ -1366,20 +2413,41 @@ class SmartCRUDL(object):
         else:
             return r'^%s/%s/$' % (self.path, action)            
 
+    def lazy_view(self, action):
+        """
+        Returns a view function for the passed in action which builds our view class the first time it is called
+        """
+        def view(request, *args, **kwargs):
+            if action not in self._view_functions:
+                start = time.time()
+                self._view_functions[action] = self.view_for_action(action).as_view()
+                self.record_timing(time.time() - start, "%s view" % action)
+
+            return self._view_functions[action](request, *args, **kwargs)
+
+        # take on any attributes set by decorators on our dispatch, such as csrf_exempt, like as_view() does
+        update_wrapper(view, self.base_view_for_action(action).dispatch, assigned=())
+        return view
+
     def as_urlpatterns(self):
         """
-        Creates the appropriate URL patterns for this object.
+        Creates the appropriate URL patterns for this object.  These are only built once per process, and the
+        view for each action isn't built until it is first used.
         """
-        urlpatterns = patterns('')
-        
-        # for each of our actions
-        for action in self.actions:
-            view_class = self.view_for_action(action)
-            view_pattern = self.pattern_for_view(view_class, action)
-            name = self.url_name_for_action(action)
-            urlpatterns += patterns('', url(view_pattern, view_class.as_view(), name=name))
+        key = (self.__class__, self.model, self.path, tuple(self.actions))
 
-        return urlpatterns
+        if key not in _crudl_urlpatterns:
+            start = time.time()
 
+            # for each of our actions
+            urls = []
+            for action in self.actions:
+                view_pattern = self.pattern_for_view(self.base_view_for_action(action), action)
+                name = self.url_name_for_action(action)
+                urls.append(url(view_pattern, self.lazy_view(action), name=name))
 
+            _crudl_urlpatterns[key] = patterns('', *urls)
+            self.record_timing(time.time() - start, "URL patterns")
 
+        # callers often add to the patterns we return, so they get their own copy
+        return list(_crudl_urlpatterns[key])
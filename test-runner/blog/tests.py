@@ -1,14 +1,17 @@
-from django.test import TestCase
-from django.test.client import Client
-from django.core.urlresolvers import reverse
-from django.contrib.auth.models import User, Group
+from django.test import TestCase, TransactionTestCase
+from django.test.client import Client, RequestFactory
+from django.core.urlresolvers import reverse, NoReverseMatch
+from django.contrib.auth.models import User, Group, Permission
+from django.core.exceptions import ImproperlyConfigured
+from django.test.utils import override_settings
 from blog.models import Post, Category
 from smartmin.management import check_role_permissions
 from django.utils import simplejson
 from .views import PostCRUDL
-from smartmin.views import smart_url
-from guardian.shortcuts import assign
+from smartmin.views import smart_url, SmartCsvView
+from guardian.shortcuts import assign, remove_perm
 import settings
+import re
 
 
 from smartmin.users.models import *
@@ -61,6 +64,16 @@ class SmartminTest(TestCase):
         self.assertEquals(reverse('blog.post_create'), smart_url("/blog/post/create/"))
         self.assertEquals(reverse('blog.post_update', args=[self.post.id]), smart_url("/blog/post/update/%d/", self.post.id))
 
+        # ids are substituted into a url reversed once, other arguments are still reversed
+        from smartmin.views import reverse_with_id, _url_templates, URL_PLACEHOLDER
+        self.assertEquals(reverse('blog.post_update', args=[1234]), smart_url("id@blog.post_update", 1234))
+        self.assertEquals(reverse('blog.post_update', args=[5]), reverse_with_id('blog.post_update', "5"))
+        self.assertEquals([reverse('blog.post_update', args=[URL_PLACEHOLDER])],
+                          [template for (key, template) in _url_templates.items() if key[0] == 'blog.post_update'])
+        self.assertRaises(NoReverseMatch, reverse_with_id, 'blog.post_update', 'abc')
+        self.assertRaises(NoReverseMatch, reverse_with_id, 'blog.post_update', u'caf\xe9')
+        self.assertEquals(reverse('blog.post_update', args=[u'\u0661\u0662']), reverse_with_id('blog.post_update', u'\u0661\u0662'))
+
     def test_permissions(self):
         create_url = reverse('blog.post_create')
 
@@ -199,6 +212,1040 @@ class SmartminTest(TestCase):
         self.assertEquals(5, len(json_list))
         self.assertEquals(post1.title, json_list[0]['title'])
 
+    def test_cursor_pagination(self):
+        for title, order in (("Delta", 2), ("Alpha", 1), ("Echo", 1), ("Bravo", 2), ("Charlie", 1)):
+            Post.objects.create(title=title, body="Post Body", order=order, tags="post",
+                                created_by=self.author, modified_by=self.author)
+
+        list_view = PostCRUDL().view_for_action('list')
+        view = type('CursorList', (list_view,), dict(cursor_paginate=True, paginate_by=2)).as_view()
+
+        def get_page(params):
+            request = RequestFactory().get(reverse('blog.post_list'), params)
+            request.user = self.author
+            return view(request)
+
+        def walk(params):
+            titles = []
+            cursors = []
+            response = get_page(params)
+            while True:
+                page = response.context_data['page_obj']
+                titles += [post.title for post in page]
+                cursors.append(page.previous_cursor)
+                if not page.has_next():
+                    return titles, cursors, response
+                response = get_page(dict(params, _cursor=page.next_cursor))
+
+        # walking forwards visits every post exactly once, in order
+        titles, cursors, response = walk(dict())
+        self.assertEquals(["Alpha", "Bravo", "Charlie", "Delta", "Echo", "Test Post"], titles)
+        self.assertEquals(None, cursors[0])
+        self.assertFalse(response.context_data['paginator'])
+
+        # and seeking backwards from the last page gets us the previous one
+        response = get_page(dict(_cursor=cursors[-1]))
+        self.assertEquals(["Charlie", "Delta"], [post.title for post in response.context_data['page_obj']])
+
+        # our links carry the cursor
+        response.render()
+        self.assertIn("_cursor=", response.content)
+
+        # ties in our ordering are broken by primary key
+        titles, cursors, response = walk(dict(_order='-order'))
+        self.assertEquals([post.title for post in Post.objects.order_by('-order', 'pk')], titles)
+
+        # a cursor from another ordering is ignored, giving us the first page
+        response = get_page(dict(_cursor=cursors[-1]))
+        self.assertEquals(["Alpha", "Bravo"], [post.title for post in response.context_data['page_obj']])
+
+        # as is garbage
+        response = get_page(dict(_cursor="garbage"))
+        self.assertEquals(["Alpha", "Bravo"], [post.title for post in response.context_data['page_obj']])
+
+        # orderings we can't seek through fall back to our default ordering rather than skipping rows
+        for order in ('?', 'created_by__username', 'not_a_field'):
+            titles, cursors, response = walk(dict(_order=order))
+            self.assertEquals(["Alpha", "Bravo", "Charlie", "Delta", "Echo", "Test Post"], titles)
+
+    def test_count_strategies(self):
+        from django.core.cache import cache
+        cache.clear()
+
+        view = PostCRUDL().view_for_action('list')()
+        view.request = RequestFactory().get(reverse('blog.post_list'))
+        view.request.user = self.author
+
+        for i in range(5):
+            Post.objects.create(title="Post %d" % i, body="Post Body", order=i, tags="post",
+                                created_by=self.author, modified_by=self.author)
+
+        self.assertEquals((6, False), view.count_queryset(Post.objects.all()))
+
+        # cached counts don't see new posts until they expire
+        view.count_strategy = 'cached'
+        self.assertEquals((6, False), view.count_queryset(Post.objects.all()))
+        Post.objects.create(title="Late Post", body="Post Body", order=0, tags="post",
+                            created_by=self.author, modified_by=self.author)
+        self.assertEquals((6, False), view.count_queryset(Post.objects.all()))
+
+        # but different filters get their own count
+        self.assertEquals((1, False), view.count_queryset(Post.objects.filter(title__icontains="late")))
+
+        # small estimated counts are exact
+        view.count_strategy = 'estimated'
+        self.assertEquals((2, False), view.count_queryset(Post.objects.filter(order__gte=3)))
+
+        # larger ones are extrapolated from a sample
+        view.count_estimate_threshold = 2
+        (count, estimated) = view.count_queryset(Post.objects.filter(order__gte=0))
+        self.assertTrue(estimated)
+        self.assertTrue(count >= 2)
+
+        # we sample across the whole table, so a filter on old posts isn't missed by only looking at new ones
+        view.count_estimate_threshold = 4
+        view.count_estimate_ranges = 2
+        for i in range(20):
+            Post.objects.create(title="Newer Post %d" % i, body="Post Body", order=100, tags="post",
+                                created_by=self.author, modified_by=self.author)
+        (count, estimated) = view.count_queryset(Post.objects.filter(order__lt=100))
+        self.assertTrue(estimated)
+        self.assertTrue(count > 4)
+
+        # sqlite keeps no estimate of table sizes, so we estimate that from our sample
+        self.assertEquals(None, view.estimate_table_count(Post, 'default'))
+
+        view.count_strategy = 'bogus'
+        self.assertRaises(ImproperlyConfigured, view.count_queryset, Post.objects.all())
+
+        # counts which may be off still let us page past them, here a cached count from before most posts existed
+        from django.core.paginator import EmptyPage
+        view.count_strategy = 'cached'
+        paginator = view.get_paginator(Post.objects.all(), 10)
+        self.assertEquals((6, 1), (paginator.count, paginator.num_pages))
+
+        page = paginator.page(2)
+        self.assertEquals((11, 20, True), (page.start_index(), page.end_index(), page.has_next()))
+        page = paginator.page(3)
+        self.assertEquals((21, 27, False), (page.start_index(), page.end_index(), page.has_next()))
+        self.assertRaises(EmptyPage, paginator.page, 4)
+
+        # and through our view, whose pages past those the count knows about aren't lost
+        self.client.login(username='author', password='author')
+        PostCRUDL.List.count_strategy = 'cached'
+        try:
+            self.assertEquals(2, self.client.get(reverse('blog.post_list')).context['paginator'].num_pages)
+            for i in range(30):
+                Post.objects.create(title="Later Post %d" % i, body="Post Body", order=200, tags="post",
+                                    created_by=self.author, modified_by=self.author)
+
+            response = self.client.get(reverse('blog.post_list') + "?page=3")
+            self.assertEquals(200, response.status_code)
+            self.assertEquals(7, len(response.context['object_list']))
+            self.assertContains(response, "page=2")
+        finally:
+            PostCRUDL.List.count_strategy = 'exact'
+
+    def test_related_lookups(self):
+        view = PostCRUDL().view_for_action('list')()
+        view.request = RequestFactory().get(reverse('blog.post_list'))
+        view.request.user = self.author
+
+        # our created_by field is a foreign key, so that gets selected
+        self.assertEquals((['created_by'], []), view.derive_related_lookups())
+        self.assertEquals(dict(created_by={}), view.get_queryset().query.select_related)
+
+        # subfields are followed until they stop being relations, many to manys are prefetched
+        view.fields = ('title', 'created_by.username', 'modified_by.groups.name', 'not_a_field')
+        self.assertEquals((['created_by'], ['modified_by__groups']), view.derive_related_lookups())
+
+        # fields with get_ methods are skipped unless they tell us what they need
+        view.fields = ('title', 'is_active', 'tags')
+        self.assertEquals(([], []), view.derive_related_lookups())
+
+        view.field_config = dict(is_active=dict(related=('created_by__user_permissions',)))
+        self.assertEquals(([], ['created_by__user_permissions']), view.derive_related_lookups())
+
+        # fields are derived, so views which derive their own get their relations selected too
+        view_class = type('DerivedList', (PostCRUDL().view_for_action('list'),),
+                          dict(derive_fields=lambda self: ('title', 'modified_by.username')))
+        derived_view = view_class()
+        derived_view.request = view.request
+        self.assertEquals((['modified_by'], []), derived_view.derive_related_lookups())
+
+        # and they are only derived once per queryset
+        derived = []
+        def derive_related_lookups():
+            derived.append(True)
+            return view_class.derive_related_lookups(derived_view)
+
+        derived_view.derive_related_lookups = derive_related_lookups
+        self.assertEquals(dict(modified_by={}), derived_view.get_queryset().query.select_related)
+        self.assertEquals(1, len(derived))
+
+        # views deriving their fields from their object list can't tell us their fields before it exists
+        view_class = type('ObjectListFieldsList', (PostCRUDL().view_for_action('list'),),
+                          dict(derive_fields=lambda self: ('title', 'created_by.username') if self.object_list else ()))
+        derived_view = view_class()
+        derived_view.request = view.request
+        derived_view.fields = None
+        self.assertEquals(([], []), derived_view.derive_related_lookups())
+        self.assertFalse(derived_view.get_queryset().query.select_related)
+
+        # so we only look at the fields they declare
+        derived_view.fields = ('title', 'modified_by.username')
+        self.assertEquals(dict(modified_by={}), derived_view.get_queryset().query.select_related)
+
+        # reverse relations are followed by their accessor name
+        from smartmin.users.views import UserCRUDL
+        user_view = UserCRUDL().view_for_action('list')()
+        user_view.fields = ('username', 'post_creations', 'recoverytoken_set')
+        self.assertEquals(([], ['post_creations', 'recoverytoken_set']), user_view.derive_related_lookups())
+
+        # and views can always set them explicitly
+        view.select_related = ('modified_by',)
+        view.prefetch_related = ()
+        self.assertEquals(('modified_by',), view.derive_select_related())
+        self.assertEquals((), view.derive_prefetch_related())
+
+    @override_settings(PERMISSIONS_CACHE_LOCAL=True)
+    def test_list_permission(self):
+        from django.core.cache import cache
+        from django.contrib.auth.models import AnonymousUser
+        from smartmin.perms import get_object_ids_for_user
+        cache.clear()
+
+        other_post = Post.objects.create(title="Other Post", body="Post Body", order=1, tags="post",
+                                         created_by=self.author, modified_by=self.author)
+
+        view = PostCRUDL().view_for_action('list')()
+        view.list_permission = 'blog.post_update'
+        view.request = RequestFactory().get(reverse('blog.post_list'))
+        view.request.user = self.plain
+
+        # plain users can't update anything
+        self.assertEquals([], list(view.get_queryset()))
+
+        # until we give them permission on a post
+        assign('blog.post_update', self.plain, self.post)
+        self.assertEquals([self.post], list(view.get_queryset()))
+
+        # our object ids are cached until permissions change
+        self.assertNumQueries(0, get_object_ids_for_user, self.plain.id, 'blog.post_update', Post)
+
+        # permissions can come through groups as well
+        group = Group.objects.create(name="Other Editors")
+        assign('blog.post_update', group, other_post)
+        self.assertEquals([self.post], list(view.get_queryset()))
+
+        self.plain.groups.add(group)
+        self.assertEquals(set([self.post, other_post]), set(view.get_queryset()))
+
+        remove_perm('blog.post_update', self.plain, self.post)
+        self.assertEquals([other_post], list(view.get_queryset()))
+
+        # anonymous users get guardian's anonymous user permissions
+        view.request.user = AnonymousUser()
+        self.assertEquals([], list(view.get_queryset()))
+        assign('blog.post_update', User.objects.get(pk=settings.ANONYMOUS_USER_ID), self.post)
+        self.assertEquals([self.post], list(view.get_queryset()))
+
+        # editors can update every post
+        view.request.user = self.editor
+        self.assertEquals(2, view.get_queryset().count())
+
+        # users with permissions on more objects than we cache ids for get filtered by a subquery
+        view.request.user = self.plain
+        with override_settings(PERMISSIONS_CACHE_MAX_IDS=1):
+            cache.clear()
+            assign('blog.post_update', self.plain, self.post)
+            self.assertEquals(None, get_object_ids_for_user(self.plain.id, 'blog.post_update', Post))
+            self.assertEquals(set([self.post, other_post]), set(view.get_queryset()))
+
+            remove_perm('blog.post_update', self.plain, self.post)
+            self.assertEquals(set([other_post.id]), get_object_ids_for_user(self.plain.id, 'blog.post_update', Post))
+            self.assertEquals([other_post], list(view.get_queryset()))
+
+    @override_settings(PERMISSIONS_CACHE_LOCAL=True)
+    def test_permission_caching(self):
+        from smartmin.perms import get_anonymous_permissions, get_object_ids_for_user
+
+        # our anonymous permissions are cached, but see changes
+        anon = User.objects.get(pk=settings.ANONYMOUS_USER_ID)
+        self.assertTrue('blog.post_read' in get_anonymous_permissions())
+        self.assertNumQueries(0, get_anonymous_permissions)
+
+        # unless our cache is local to this process, as other processes wouldn't see our changes
+        with override_settings(PERMISSIONS_CACHE_LOCAL=False):
+            self.assertTrue('blog.post_read' in get_anonymous_permissions())
+            self.assertNumQueries(3, get_anonymous_permissions)
+
+            get_object_ids_for_user(self.plain.id, 'blog.post_update', Post)
+            self.assertNumQueries(2, get_object_ids_for_user, self.plain.id, 'blog.post_update', Post)
+
+        assign('blog.post_list', anon)
+        self.assertTrue('blog.post_list' in get_anonymous_permissions())
+        remove_perm('blog.post_list', anon)
+        self.assertFalse('blog.post_list' in get_anonymous_permissions())
+
+        # the object loaded when checking object permissions is reused as our object
+        assign('blog.post_update', self.plain, self.post)
+        view = PostCRUDL().view_for_action('update')()
+        request = RequestFactory().get(reverse('blog.post_update', args=[self.post.id]))
+        request.user = self.plain
+
+        self.assertTrue(view.has_permission(request, pk=self.post.id))
+        self.assertNumQueries(0, view.get_object)
+        self.assertEquals(self.post, view.get_object())
+
+        # as are permission decisions
+        self.assertNumQueries(0, view.user_has_perm, 'blog.post_update', self.post)
+
+    def test_csv_export(self):
+        for i in range(4):
+            Post.objects.create(title="Post %d" % i, body='Body, with "quotes"', order=i, tags="post",
+                                created_by=self.author, modified_by=self.author)
+
+        options = dict(model=Post, fields=('title', 'body', 'created_by', 'is_active'), default_order='pk')
+        csv_view = type('PostCsvView', (SmartCsvView,), options)
+        streaming_view = type('PostStreamingView', (SmartCsvView,), dict(options, streaming=True, chunk_size=2))
+
+        def get_csv(view):
+            request = RequestFactory().get('/blog/post/csv/')
+            request.user = self.author
+            return view.as_view()(request)
+
+        response = get_csv(csv_view)
+        lines = response.content.splitlines()
+        self.assertEquals('"Title","Body","Created By",""', lines[0])
+        self.assertEquals('"Post 0","Body, with ""quotes""","author","<div class=""active_icon""></div>"', lines[2])
+        self.assertEquals(6, len(lines))
+
+        # streamed responses are generated as they are read, but end up the same
+        response = get_csv(streaming_view)
+        self.assertTrue(response._base_content_is_iter)
+        self.assertEquals(lines, response.content.splitlines())
+
+        # when every field is a column, rows are read with values_list
+        options['fields'] = ('title', 'body', 'created_by.username', 'created_on', 'order')
+        values_view = type('PostValuesView', (SmartCsvView,), options)
+        self.assertEquals(['title', 'body', 'created_by__username', 'created_on', 'order'],
+                          values_view().derive_value_lookups(options['fields']))
+
+        # which gives us the same output as looking them up on objects
+        def lookup_field_value(self, context, obj, field):
+            return super(object_view, self).lookup_field_value(context, obj, field)
+
+        object_view = type('PostObjectView', (SmartCsvView,), dict(options, lookup_field_value=lookup_field_value))
+        self.assertEquals(None, object_view().derive_value_lookups(options['fields']))
+        self.assertEquals(get_csv(object_view).content, get_csv(values_view).content)
+
+        # get_ methods, relations and properties all need objects
+        view = values_view()
+        self.assertEquals(None, view.derive_value_lookups(('title', 'is_active')))
+        self.assertEquals(None, view.derive_value_lookups(('title', 'created_by')))
+        self.assertEquals(None, view.derive_value_lookups(('title', 'created_by.groups.name')))
+        self.assertEquals(None, view.derive_value_lookups(('title', 'pk')))
+
+        # rows are read a page at a time, each its own query, seeking past the last row of the one before
+        view = type('PostPagedView', (SmartCsvView,), dict(options, default_order='-order', chunk_size=2))()
+        view.request = RequestFactory().get('/blog/post/csv/')
+        queryset = Post.objects.all()
+        self.assertEquals(['-order', 'pk'], view.derive_cursor_ordering(queryset))
+        self.assertTrue(view.can_seek(Post, ['-order', 'pk']))
+
+        pages = []
+        self.assertNumQueries(3, lambda: pages.extend(view.iterate_pages(queryset)))
+        self.assertEquals([["Post 3", "Post 2"], ["Post 1", "Test Post"], ["Post 0"]],
+                          [[post.title for post in page] for page in pages])
+
+        self.assertEquals([[("Post 3",), ("Post 2",)], [("Post 1",), ("Test Post",)], [("Post 0",)]],
+                          list(view.iterate_pages(queryset, ['title'])))
+
+        # orderings which can't be seeked through are read by offset instead
+        self.assertFalse(view.can_seek(Post, ['created_by__username', 'pk']))
+        view.default_order = 'created_by__username'
+        self.assertEquals([2, 2, 1], [len(page) for page in view.iterate_pages(queryset)])
+
+    def test_csv_import(self):
+        from smartmin.csv_imports.models import ImportTask
+        import tempfile
+        import os
+
+        tasks = []
+
+        def import_posts(csv):
+            temp = tempfile.NamedTemporaryFile(dir='.', suffix='.csv')
+            temp.write(csv)
+            temp.flush()
+
+            task = ImportTask(csv_file=os.path.basename(temp.name), created_by=self.author, modified_by=self.author)
+            tasks.append(task)
+            try:
+                return Post.import_csv(task)
+            finally:
+                temp.close()
+
+        self.assertTrue(Post.can_bulk_import())
+
+        # models which need save() called for each row can't be bulk imported
+        from django.db.models.signals import pre_save, post_save
+        def on_save(sender, **kwargs):
+            pass
+
+        for signal in (pre_save, post_save):
+            signal.connect(on_save, sender=Post)
+            try:
+                self.assertFalse(Post.can_bulk_import())
+            finally:
+                signal.disconnect(on_save, sender=Post)
+
+        SavingPost = type('SavingPost', (Post,), dict(__module__='blog.models', save=lambda self, *args, **kwargs: None,
+                                                      Meta=type('Meta', (), dict(proxy=True))))
+        self.assertFalse(SavingPost.can_bulk_import())
+        self.assertTrue(Post.can_bulk_import())
+        Post.import_batch_size = 2
+        try:
+            records = import_posts(open('blog/test_files/posts.csv').read())
+            self.assertEquals(4, len(records))
+            self.assertEquals(5, Post.objects.all().count())
+            self.assertEquals(4, Post.objects.filter(title__startswith="My ", created_by=self.author).count())
+
+            # our progress is tracked as we go, but only written out every so often
+            task = ImportTask.objects.get(pk=tasks[0].pk)
+            self.assertEquals((0, 0, 22), (task.rows_processed, task.rows_failed, task.bytes_read))
+
+            tasks[0].flush()
+            task = ImportTask.objects.get(pk=tasks[0].pk)
+            self.assertEquals((4, 0, 229), (task.rows_processed, task.rows_failed, task.bytes_read))
+
+            # progress is written on a connection of its own, except with SQLite which locks the whole database
+            from smartmin.csv_imports.models import get_progress_db, PROGRESS_DB_ALIAS
+            from django.db import connections
+            self.assertEquals('default', get_progress_db())
+
+            engine = connections.databases['default']['ENGINE']
+            connections.databases['default']['ENGINE'] = 'django.db.backends.postgresql_psycopg2'
+            try:
+                self.assertEquals(PROGRESS_DB_ALIAS, get_progress_db())
+                self.assertEquals(connections.databases['default']['NAME'], connections.databases[PROGRESS_DB_ALIAS]['NAME'])
+            finally:
+                connections.databases['default']['ENGINE'] = engine
+                connections.databases.pop(PROGRESS_DB_ALIAS, None)
+
+            # a bad value fails its batch, which is then retried a row at a time so we know the line at fault
+            csv = 'title,body,order,tags\nA,A,1,a\nB,B,2,b\nC,C,x,c\nD,D,4,d\n'
+            try:
+                import_posts(csv)
+                self.fail("Import should have failed")
+            except Exception as e:
+                self.assertTrue(str(e).startswith("Line 4:"), str(e))
+
+            self.assertEquals((2, 1), (tasks[1].rows_processed, tasks[1].rows_failed))
+
+            self.assertEquals(['A', 'B'], [p.title for p in Post.objects.filter(title__in=['A', 'B', 'C', 'D'])])
+
+            # without savepoints, bulk inserts split into several statements can't be partly undone, so rows are
+            # checked before any are inserted and none are inserted twice
+            Post.import_batch_size = 1000
+            rows = ["Row %d,R,%s,r" % (i, 'x' if i == 250 else i) for i in range(300)]
+            try:
+                import_posts('title,body,order,tags\n' + '\n'.join(rows) + '\n')
+                self.fail("Import should have failed")
+            except Exception as e:
+                self.assertTrue(str(e).startswith("Line 252:"), str(e))
+
+            self.assertEquals(250, Post.objects.filter(tags='r').count())
+            self.assertEquals(250, len(set(Post.objects.filter(tags='r').values_list('title', flat=True))))
+            Post.import_batch_size = 2
+
+            # as do rows with the wrong number of fields
+            try:
+                import_posts('title,body,order,tags\nE,E,1,e\nF,F,2\n')
+                self.fail("Import should have failed")
+            except Exception as e:
+                self.assertTrue(str(e).startswith("Line 3:"), str(e))
+
+            self.assertTrue(Post.objects.filter(title='E'))
+        finally:
+            Post.import_batch_size = 1000
+
+        # non-ascii characters are read as cp1252
+        records = import_posts('title,body,order,tags\nCaf\x8e,\x93Quoted\x94,1,a\n')
+        self.assertEquals((u'Caf\u017d', u'\u201cQuoted\u201d'), (records[0].title, records[0].body))
+
+        # unless our file has mac_roman characters in it
+        records = import_posts('title,body,order,tags\nCaf\x8e,Gar\x8don,1,a\n')
+        self.assertEquals((u'Caf\xe9', u'Gar\xe7on'), (records[0].title, records[0].body))
+
+        # even if we only see them well past its start, in which case the rows before them are read as mac_roman too
+        Post.import_detect_bytes = 32
+        try:
+            records = import_posts('title,body,order,tags\nCaf\x8e,Body,1,a\nGar\x8don,Caf\x8e,2,b\n')
+            self.assertEquals(u'Caf\xe9', records[0].title)
+            self.assertEquals((u'Gar\xe7on', u'Caf\xe9'), (records[1].title, records[1].body))
+        finally:
+            Post.import_detect_bytes = 65536
+
+    def test_chunked_csv_import(self):
+        from smartmin.csv_imports.models import ImportTask
+        from smartmin.csv_imports.tasks import csv_import
+        import datetime
+        import tempfile
+        import os
+
+        temp = tempfile.NamedTemporaryFile(dir='.', suffix='.csv')
+        temp.write('title,body,order,tags\nA,"Multi\nline body",1,a\nB,B,2,b\nC,C,3,c\nD,D,x,d\n')
+        temp.flush()
+
+        task = ImportTask.objects.create(csv_file=os.path.basename(temp.name), model_class='blog.models.Post',
+                                         created_by=self.author, modified_by=self.author)
+
+        Post.import_chunk_bytes = 10
+        try:
+            # chunks end on rows, even when quoted values span lines
+            self.assertEquals([(22, 46, 1), (46, 62, 2), (62, None, 4)], Post.split_csv(task))
+
+            # each chunk is imported on its own, then their results merged back into our task
+            csv_import(task)
+        finally:
+            Post.import_chunk_bytes = None
+
+        self.assertEquals(['A', 'B', 'C'], [p.title for p in Post.objects.filter(tags__in=['a', 'b', 'c', 'd']).order_by('order')])
+        self.assertEquals("Multi\nline body", Post.objects.get(title='A').body)
+
+        task = ImportTask.objects.get(pk=task.pk)
+        self.assertEquals(3, task.rows_processed)
+        self.assertTrue(task.import_log.find("Importing in 3 chunks") > 0)
+        self.assertTrue(task.import_log.find("Error: Line 5:") > 0)
+        self.assertTrue(task.import_log.find("3 record(s) added.") > 0)
+
+        # the chunk which failed is remembered, resuming retries just it so the others aren't imported twice
+        self.assertEquals([(62, None, 4)], task.get_failed_chunks())
+
+        ImportTask.objects.filter(pk=task.pk).update(modified_on=datetime.datetime.now() - datetime.timedelta(hours=1))
+        task = ImportTask.objects.get(pk=task.pk)
+        self.assertTrue(task.can_resume())
+
+        temp.seek(66)
+        temp.write('4')
+        temp.flush()
+
+        try:
+            task.resume()
+        finally:
+            temp.close()
+
+        task = ImportTask.objects.get(pk=task.pk)
+        self.assertEquals(['A', 'B', 'C', 'D'], [p.title for p in Post.objects.filter(tags__in=['a', 'b', 'c', 'd']).order_by('order')])
+        self.assertEquals(4, task.rows_processed)
+        self.assertTrue(task.import_log.find("Retrying 1 failed chunk(s)") > 0)
+        self.assertTrue(task.import_log.find("1 record(s) added.") > 0)
+        self.assertFalse(task.failed_chunks)
+
+        # quotes inside unquoted values don't start quoted ones, just as when the file is read
+        temp = tempfile.NamedTemporaryFile(dir='.', suffix='.csv')
+        temp.write('title,body,order,tags\nE,5" tall,5,e\nF,F,6,f\nG,G,7,g\n')
+        temp.flush()
+
+        task = ImportTask.objects.create(csv_file=os.path.basename(temp.name), model_class='blog.models.Post',
+                                         created_by=self.author, modified_by=self.author)
+        Post.import_chunk_bytes = 10
+        try:
+            self.assertEquals([(22, 36, 1), (36, 52, 2)], Post.split_csv(task))
+        finally:
+            Post.import_chunk_bytes = None
+            temp.close()
+
+    def test_resumable_csv_import(self):
+        from smartmin.csv_imports.models import ImportTask
+        from smartmin.csv_imports.tasks import csv_import
+        import datetime
+        import tempfile
+        import os
+
+        temp = tempfile.NamedTemporaryFile(dir='.', suffix='.csv')
+        temp.write('title,body,order,tags\nA,A,1,a\nB,B,2,b\nC,C,3,c\nD,D,x,d\nE,E,5,e\n')
+        temp.flush()
+
+        task = ImportTask.objects.create(csv_file=os.path.basename(temp.name), model_class='blog.models.Post',
+                                         created_by=self.author, modified_by=self.author)
+        read_url = reverse('csv_imports.importtask_read', args=[task.pk])
+        resume_url = reverse('csv_imports.importtask_resume', args=[task.pk])
+
+        Post.import_resumable = True
+        Post.import_batch_size = 2
+        try:
+            # we fail on line 5, but our first batch was committed
+            self.assertRaises(Exception, csv_import, task)
+
+            task = ImportTask.objects.get(pk=task.pk)
+            self.assertEquals((3, 38), (task.checkpoint_line, task.checkpoint_offset))
+
+            # our test transactions aren't really rolled back, so do that ourselves, then fix our file
+            Post.objects.filter(title='C').delete()
+            temp.seek(0)
+            temp.write('title,body,order,tags\nA,A,1,a\nB,B,2,b\nC,C,3,c\nD,D,4,d\nE,E,5,e\n')
+            temp.flush()
+
+            # we can resume once we look dead
+            self.assertFalse(task.can_resume())
+            ImportTask.objects.filter(pk=task.pk).update(modified_on=datetime.datetime.now() - datetime.timedelta(hours=1))
+
+            # and none of our workers still has it
+            class Inspect(object):
+                def __init__(self, active):
+                    self._active = active
+                def active(self):
+                    return self._active
+                def reserved(self):
+                    return {}
+                def scheduled(self):
+                    return None
+
+            task = ImportTask.objects.get(pk=task.pk)
+            control = csv_import.app.control
+            inspect = control.inspect
+            csv_import.app.conf.CELERY_ALWAYS_EAGER = False
+            try:
+                control.inspect = lambda timeout: Inspect({'worker1': [dict(id=task.task_id)]})
+                self.assertTrue(task.is_resumable())
+                self.assertFalse(task.can_resume())
+
+                # our workers are only asked when we resume, not every time we are displayed
+                inspected = []
+                control.inspect = lambda timeout: inspected.append(timeout)
+                self.client.login(username='superuser', password='superuser')
+                response = self.client.get(read_url)
+                self.assertContains(response, resume_url)
+                self.assertEquals([], inspected)
+                self.client.logout()
+
+                control.inspect = lambda timeout: Inspect({'worker1': []})
+                self.assertTrue(task.can_resume())
+            finally:
+                control.inspect = inspect
+                csv_import.app.conf.CELERY_ALWAYS_EAGER = True
+
+            # but only with permission
+            self.client.login(username='author', password='author')
+            response = self.client.post(resume_url)
+            self.assertRedirect(response, reverse('users.user_login'))
+
+            self.client.login(username='superuser', password='superuser')
+            response = self.client.get(read_url)
+            self.assertContains(response, resume_url)
+
+            response = self.client.post(resume_url)
+            self.assertTrue(response['Location'].endswith(read_url))
+        finally:
+            Post.import_resumable = False
+            Post.import_batch_size = 1000
+            temp.close()
+
+        # we picked up after our checkpoint, so A and B weren't imported again
+        self.assertEquals(['A', 'B', 'C', 'D', 'E'], [p.title for p in Post.objects.filter(tags__in=['a', 'b', 'c', 'd', 'e']).order_by('order')])
+
+        task = ImportTask.objects.get(pk=task.pk)
+        self.assertEquals(6, task.checkpoint_line)
+        self.assertTrue(task.import_log.find("Resuming after line 3") > 0)
+        self.assertTrue(task.import_log.find("3 record(s) added.") > 0)
+
+    def test_validate_csv_import(self):
+        from smartmin.csv_imports.models import ImportTask
+        from smartmin.csv_imports.tasks import csv_import
+        import tempfile
+        import os
+
+        temp = tempfile.NamedTemporaryFile(dir='.', suffix='.csv')
+        temp.write('title,body,order,tags\nA,A,1,a\nB,B,x,b\n%s,C,3,c\nD,D,4\nE,E,5,e\n' % ('C' * 200))
+        temp.flush()
+
+        task = ImportTask.objects.create(csv_file=os.path.basename(temp.name), model_class='blog.models.Post',
+                                         validate_only=True, created_by=self.author, modified_by=self.author)
+        try:
+            csv_import(task)
+        finally:
+            temp.close()
+
+        # nothing was imported, but we found every bad row
+        self.assertFalse(Post.objects.filter(tags__in=['a', 'b', 'c', 'd', 'e']))
+
+        task = ImportTask.objects.get(pk=task.pk)
+        self.assertEquals((2, 3), (task.rows_processed, task.rows_failed))
+        self.assertTrue(task.import_log.find("3 error(s) found.") > 0)
+        self.assertTrue(task.import_log.find("Line 3: order: 'x' value must be an integer.") > 0)
+
+        try:
+            lines = task.error_report.read().splitlines()
+            self.assertEquals(['"Line","Error"',
+                               '"3","order: \'x\' value must be an integer."',
+                               '"4","title: Ensure this value has at most 128 characters (it has 200)."',
+                               '"5","The number of fields for this row is incorrect. Expected 4 but found 3."'], lines)
+        finally:
+            task.error_report.delete()
+
+    def test_upsert_csv_import(self):
+        from smartmin.csv_imports.models import ImportTask
+        import tempfile
+        import os
+
+        def import_posts(csv, user):
+            temp = tempfile.NamedTemporaryFile(dir='.', suffix='.csv')
+            temp.write(csv)
+            temp.flush()
+
+            task = ImportTask(csv_file=os.path.basename(temp.name), created_by=user, modified_by=user)
+            try:
+                return Post.import_csv(task)
+            finally:
+                temp.close()
+
+        Post.import_natural_keys = ('title',)
+        try:
+            import_posts('title,body,order,tags\nA,A1,1,a\nB,B1,2,b\n', self.author)
+            post_a = Post.objects.get(title='A')
+
+            # rows matching an existing post update it, the rest are inserted, and the last of any repeats wins,
+            # saving our task, looking up our keys, one update and one insert
+            with self.assertNumQueries(4):
+                records = import_posts('title,body,order,tags\nA,A2,1,a\nC,C1,3,c\nC,C2,3,c\n', self.superuser)
+
+            self.assertEquals(['A', 'C', 'C'], [record.title for record in records])
+            self.assertEquals(post_a.pk, records[0].pk)
+            self.assertTrue(records[1] is records[2])
+
+            self.assertEquals(['A2', 'B1', 'C2'], [p.body for p in Post.objects.filter(tags__in=['a', 'b', 'c']).order_by('title')])
+
+            post = Post.objects.get(pk=post_a.pk)
+            self.assertEquals((self.author, self.superuser), (post.created_by, post.modified_by))
+            self.assertEquals(post_a.created_on, post.created_on)
+            self.assertTrue(post.modified_on > post_a.modified_on)
+
+            # columns left out of our file are left alone, whether rows are inserted in bulk or not
+            Post.objects.filter(title='B').update(tags='keep', is_active=False)
+            import_posts('title,body,order\nB,B3,2\n', self.superuser)
+            post = Post.objects.get(title='B')
+            self.assertEquals(('B3', 'keep', False, self.superuser), (post.body, post.tags, post.is_active, post.modified_by))
+
+            # composite keys work too
+            Post.import_natural_keys = ('title', 'order')
+            import_posts('title,body,order,tags\nA,A3,1,a\nA,A4,4,a\n', self.author)
+            self.assertEquals(['A3', 'A4'], [p.body for p in Post.objects.filter(title='A').order_by('order')])
+
+            # models which can't be bulk imported save each row, updating those which match
+            Post.import_natural_keys = ('title',)
+            Post.import_batch_size = 1
+            from django.db.models.signals import post_save
+            saved = []
+            def on_save(sender, instance, **kwargs):
+                saved.append(instance.body)
+
+            post_save.connect(on_save, sender=Post)
+            try:
+                records = import_posts('title,body,order,tags\nB,B2,2,b\nD,D1,4,d\nD,D2,4,d\n', self.superuser)
+            finally:
+                post_save.disconnect(on_save, sender=Post)
+                Post.import_batch_size = 1000
+
+            self.assertEquals(['B2', 'D1', 'D2'], saved)
+            self.assertEquals(3, len(records))
+            self.assertEquals(['B2', 'D2'], [p.body for p in Post.objects.filter(tags__in=['b', 'd']).order_by('title')])
+            self.assertFalse(Post.objects.get(title='B').is_active)
+            self.assertEquals(self.author, Post.objects.get(title='B').created_by)
+
+            # our keys can't be honoured if we create our own instances
+            Post.create_instance = classmethod(lambda cls, field_dict: cls.objects.create(**field_dict))
+            try:
+                self.assertRaises(ImproperlyConfigured, import_posts, 'title,body,order,tags\nE,E1,5,e\n', self.author)
+            finally:
+                del Post.create_instance
+        finally:
+            Post.import_natural_keys = None
+
+    def test_background_export(self):
+        from smartmin.csv_exports.models import ExportTask
+
+        for i in range(3):
+            Post.objects.create(title="Post %d" % i, body="Body %d" % i, order=i + 1, tags="post",
+                                created_by=self.author, modified_by=self.author)
+
+        export_url = reverse('blog.post_export')
+
+        # need list permission to export
+        self.client.login(username='plain', password='plain')
+        response = self.client.get(export_url)
+        self.assertRedirect(response, reverse('users.user_login'))
+        self.assertFalse(ExportTask.objects.all())
+
+        # our export is queued and we are sent to a page to watch it, our tasks run inline so it's already done
+        self.client.login(username='author', password='author')
+        response = self.client.get(export_url + "?search=post+1")
+        task = ExportTask.objects.get()
+        self.assertEquals(302, response.status_code)
+        self.assertTrue(response['Location'].endswith(reverse('csv_exports.exporttask_read', args=[task.pk])))
+
+        self.assertEquals(100, task.progress)
+        self.assertEquals(self.author, task.created_by)
+        self.assertEquals("search=post+1", task.export_params)
+        self.assertEquals("testserver", simplejson.loads(task.export_meta)['SERVER_NAME'])
+        self.assertTrue(task.export_log.find("1 record(s) exported.") > 0)
+
+        try:
+            # our file is saved with a random name rather than one which could be guessed
+            self.assertTrue(re.match(r'^csv_exports/[0-9a-f]{32}\.csv$', task.csv_file.name), task.csv_file.name)
+
+            lines = task.csv_file.read().splitlines()
+            self.assertEquals(['"Title","Body","Order"', '"Post 1","Body 1","2"'], lines)
+
+            # we can check on our own exports, but not on other people's
+            response = self.client.get(reverse('csv_exports.exporttask_read', args=[task.pk]))
+            self.assertContains(response, 'width: 100%')
+
+            self.client.login(username='editor', password='editor')
+            response = self.client.get(reverse('csv_exports.exporttask_read', args=[task.pk]))
+            self.assertRedirect(response, reverse('users.user_login'))
+        finally:
+            task.csv_file.delete()
+
+        # sites served under a prefix export too, as do exports with nothing in them
+        from django.core.urlresolvers import set_script_prefix
+        self.client.login(username='author', password='author')
+        try:
+            self.client.get(export_url + "?search=nothing", SCRIPT_NAME='/prefix')
+        finally:
+            set_script_prefix('/')
+
+        task = ExportTask.objects.order_by('-pk')[0]
+        self.assertEquals(export_url, task.path)
+        self.assertEquals(100, task.progress)
+        self.assertTrue(task.export_log.find("0 record(s) exported.") > 0)
+        task.csv_file.delete()
+
+    def test_field_metadata(self):
+        from smartmin.views import get_field_metadata
+
+        (fields, orderable) = get_field_metadata(Post)
+        self.assertTrue(get_field_metadata(Post) is get_field_metadata(Post))
+        self.assertEquals(("title", "The title of this blog post, keep it relevant"), fields['title'])
+        self.assertTrue('created_by' in orderable)
+        self.assertFalse('created_by.username' in orderable)
+
+        view = PostCRUDL().view_for_action('list')()
+        self.assertEquals("Title", view.lookup_field_label(dict(), 'title'))
+        self.assertEquals("Username", view.lookup_field_label(dict(), 'created_by.username'))
+        self.assertEquals("The body of the post, go crazy", view.lookup_field_help('body'))
+        self.assertEquals(None, view.lookup_field_help('tags.foo'))
+        self.assertTrue(view.lookup_field_orderable('order'))
+        self.assertFalse(view.lookup_field_orderable('foo'))
+
+    def test_field_accessors(self):
+        from smartmin.views import get_field_accessor
+
+        self.assertTrue(get_field_accessor('created_by.username') is get_field_accessor('created_by.username'))
+        self.assertEquals("author", get_field_accessor('created_by.username')(self.post))
+        self.assertEquals(None, get_field_accessor('foo.bar')(self.post))
+        self.assertEquals(u"Test Post", get_field_accessor('__unicode__')(self.post))
+
+        other = Post.objects.create(title="Second Post", body="Body", order=2, tags="tag",
+                                    created_by=self.author, modified_by=self.author)
+
+        view = PostCRUDL().view_for_action('list')()
+        posts = [self.post, other]
+        self.assertEquals(["Test Post", "Second Post"], view.lookup_field_values(dict(), posts, 'title'))
+        self.assertEquals(["author", "author"], view.lookup_field_values(dict(), posts, 'created_by.username'))
+
+        view_class = type('TitledList', (PostCRUDL().view_for_action('list'),),
+                          dict(get_title=lambda self, obj: obj.title.upper()))
+        self.assertEquals(["TEST POST", "SECOND POST"], view_class().lookup_field_values(dict(), posts, 'title'))
+
+    def test_table_rows(self):
+        view = PostCRUDL().view_for_action('list')()
+        rows = view.lookup_table_rows(dict(link_fields=set(['title'])), [self.post], ('title', 'created_by'))
+
+        self.assertEquals(1, len(rows))
+        self.assertEquals(self.post, rows[0]['obj'])
+        self.assertEquals(dict(field='title', value="Test Post", css="field_title",
+                               link=reverse('blog.post_read', args=[self.post.id])), rows[0]['cells'][0])
+        self.assertEquals(dict(field='created_by', value=self.author, css="field_created_by", link=None),
+                          rows[0]['cells'][1])
+
+        # the rendered table has the same cells as before
+        self.client.login(username='author', password='author')
+        response = self.client.get(reverse('blog.post_list'))
+        self.assertContains(response, '<td class="value-title field_title clickable">')
+        self.assertContains(response, 'href="%s">Test Post</a>' % reverse('blog.post_read', args=[self.post.id]))
+        self.assertContains(response, '<td class="value-created_by field_created_by">')
+
+    def test_format_datetimes(self):
+        from datetime import datetime
+        from smartmin.templatetags.smartmin import format_datetime, format_datetimes, get_timezone
+
+        self.assertTrue(get_timezone('Africa/Kigali') is get_timezone('Africa/Kigali'))
+
+        noon = datetime(2013, 1, 1, 12, 0)
+        self.assertEquals("Jan 01, 2013 12:00", format_datetime(noon))
+        self.assertEquals(["Jan 01, 2013 20:00", "Jan 02, 2013 20:00", None, "text"],
+                          format_datetimes([noon, datetime(2013, 1, 2, 12, 0), None, "text"], 'Africa/Kigali'))
+
+        # views can show dates in their own timezone
+        view_class = type('KigaliList', (PostCRUDL().view_for_action('list'),),
+                          dict(derive_timezone=lambda self: 'Africa/Kigali'))
+        view = view_class()
+        view.request = RequestFactory().get(reverse('blog.post_list'))
+        view.kwargs = {}
+        view.object_list = view.get_queryset()
+        context = view.get_context_data(object_list=view.object_list)
+        self.assertEquals('Africa/Kigali', context['user_timezone'])
+
+        self.post.created_on = noon
+        self.post.save()
+        request = RequestFactory().get(reverse('blog.post_list'))
+        request.user = self.superuser
+        response = view_class.as_view()(request)
+        response.render()
+        self.assertIn("Jan 01, 2013 20:00", response.content)
+
+    def test_profile_middleware(self):
+        import os
+        import pstats
+        import shutil
+        import tempfile
+        import time
+        from django.http import HttpResponse
+        from django.test.utils import override_settings
+        from smartmin.middleware import ProfileMiddleware, get_profiles
+
+        def slow_view(request):
+            time.sleep(0.05)
+            return HttpResponse("slow")
+
+        middleware = ProfileMiddleware()
+
+        def handle(path, user):
+            # runs a request through our middleware the way django's handler does
+            request = RequestFactory().get(path)
+            request.user = user
+            self.assertEquals(None, middleware.process_view(request, slow_view, (), {}))
+            return middleware.process_response(request, slow_view(request))
+
+        directory = tempfile.mkdtemp()
+        try:
+            with override_settings(PROFILE_DIR=directory, PROFILE_STORE_SIZE=2):
+                # requests without profile in their query string are left alone
+                self.assertEquals("slow", handle('/slow/', self.superuser).content)
+                self.assertFalse(get_profiles())
+
+                # as are those of users who aren't allowed to profile
+                self.assertEquals("slow", handle('/slow/?profile', self.plain).content)
+                self.assertFalse(get_profiles())
+
+                # superusers get the cProfile stats back
+                response = handle('/slow/?profile', self.superuser)
+                self.assertIn("slow_view", response.content)
+                self.assertEquals('cprofile', get_profiles()[-1].mode)
+
+                # or the sampled stacks, as does anybody PROFILE_ALLOWED lets in
+                with override_settings(PROFILE_ALLOWED=lambda request: request.user.username == 'plain'):
+                    response = handle('/slow/?profile=sample', self.plain)
+                    self.assertIn("tests.py:slow_view", response.content)
+                    self.assertEquals('sample', get_profiles()[-1].mode)
+
+                # some fraction of other requests are profiled as they go
+                with override_settings(PROFILE_SAMPLE_RATE=1):
+                    response = handle('/slow/', self.plain)
+                    self.assertEquals("slow", response.content)
+
+                self.assertEquals(['/slow/', '/slow/'], [profile.path for profile in get_profiles()])
+
+                # everything was saved too, in formats pstats and flame graph tools can read
+                files = sorted(os.listdir(directory))
+                self.assertEquals(3, len(files))
+                pstats.Stats(os.path.join(directory, [f for f in files if f.endswith('.pstats')][0]))
+                folded = open(os.path.join(directory, [f for f in files if f.endswith('.folded')][0])).read()
+                self.assertIn(";tests.py:slow_view ", folded)
+
+            # profiled requests go through every other middleware and have their templates rendered as usual
+            middleware_classes = ('smartmin.middleware.ProfileMiddleware',) + settings.MIDDLEWARE_CLASSES
+            with override_settings(MIDDLEWARE_CLASSES=middleware_classes):
+                client = Client(enforce_csrf_checks=True)
+                client.login(username='superuser', password='superuser')
+
+                response = client.get(reverse('blog.post_list') + "?profile")
+                self.assertIn("render", response.content)
+                self.assertEquals(reverse('blog.post_list'), get_profiles()[-1].path)
+
+                # including csrf checks, which reject this post before it gets to our view
+                response = client.post(reverse('blog.post_create') + "?profile", dict(title="Profiled"))
+                self.assertIn("csrf.py", response.content)
+                self.assertFalse(Post.objects.filter(title="Profiled"))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_view_timings(self):
+        from django.test.utils import override_settings
+
+        self.client.login(username='author', password='author')
+        list_url = reverse('blog.post_list')
+
+        # off by default
+        response = self.client.get(list_url)
+        self.assertFalse(response.has_header('Server-Timing'))
+
+        with override_settings(VIEW_TIMINGS=True):
+            response = self.client.get(list_url)
+            self.assertEquals(200, response.status_code)
+            self.assertContains(response, "Test Post")
+
+            phases = [timing.split(';')[0] for timing in response['Server-Timing'].split(', ')]
+            self.assertEquals(['permission', 'pre_process', 'queryset', 'context', 'render', 'total'], phases)
+
+            # or as json
+            response = self.client.get(list_url + "?_timings=1")
+            summary = simplejson.loads(response.content)
+            self.assertEquals('application/json', response['Content-Type'])
+            self.assertEquals(phases, [timing['phase'] for timing in summary])
+
+            total = summary[-1]
+            self.assertTrue(total['queries'] > 0)
+            self.assertEquals(total['queries'], sum([timing['queries'] for timing in summary[:-1]]))
+
+            # failed permission checks are timed too
+            self.client.logout()
+            response = self.client.get(reverse('blog.post_create'))
+            self.assertIsLogin(response)
+            self.assertTrue(response['Server-Timing'].startswith('permission;'))
+
+    def test_crudl_urlpatterns(self):
+        from smartmin.views import crudl_timing_report
+
+        # our patterns are only built once, but everybody gets their own copy
+        patterns = PostCRUDL().as_urlpatterns()
+        self.assertEquals([p.regex.pattern for p in patterns], [p.regex.pattern for p in PostCRUDL().as_urlpatterns()])
+        self.assertEquals([p.callback for p in patterns], [p.callback for p in PostCRUDL().as_urlpatterns()])
+        self.assertFalse(patterns is PostCRUDL().as_urlpatterns())
+
+        # views are built when they are first used, and only then
+        crudl = PostCRUDL()
+        crudl.actions = ('list', 'read')
+        list_view = crudl.as_urlpatterns()[0].callback
+        self.assertFalse(crudl._views)
+
+        request = RequestFactory().get(reverse('blog.post_list'))
+        request.user = self.superuser
+        self.assertEquals(200, list_view(request).status_code)
+        self.assertEquals(['list'], crudl._views.keys())
+        self.assertTrue(crudl.view_for_action('list') is crudl.view_for_action('list'))
+
+        self.assertTrue(crudl_timing_report().find("blog.views.PostCRUDL") > 0)
+
+        # the report can also be printed with a command
+        from django.core.management import call_command
+        import StringIO
+        output = StringIO.StringIO()
+        call_command('crudl_timings', stdout=output)
+        self.assertIn("ms  blog.views.PostCRUDL\n", output.getvalue())
+
     def test_success_url(self):
         self.client.login(username='author', password='author')
 
@@ -273,6 +1320,43 @@ class SmartminTest(TestCase):
         # removing all category actions should bring us to 10
         self.assertEquals(11, authors.permissions.all().count())
 
+        # granting them back again adds the category permissions in bulk
+        check_role_permissions(authors, settings.GROUP_PERMISSIONS['Authors'], authors.permissions.all())
+        self.assertEquals(16, authors.permissions.all().count())
+
+        # and once everything is in sync, we only need to look
+        with self.assertNumQueries(3):
+            check_role_permissions(authors, settings.GROUP_PERMISSIONS['Authors'], authors.permissions.all())
+
+        # sync_permissions does the whole sync once, optionally only printing what it would change
+        from StringIO import StringIO
+        from django.core.management import call_command
+
+        check_role_permissions(authors, permissions, authors.permissions.all())
+        Permission.objects.filter(codename='post_author').delete()
+
+        output = StringIO()
+        call_command('sync_permissions', dry_run=True, stdout=output)
+        self.assertIn("  + blog.post_author\n", output.getvalue())
+        self.assertIn("  + Authors: blog.category_create\n", output.getvalue())
+        self.assertEquals(10, authors.permissions.all().count())
+        self.assertFalse(Permission.objects.filter(codename='post_author'))
+
+        output = StringIO()
+        call_command('sync_permissions', stdout=output)
+        self.assertIn("  + blog.post_author\n", output.getvalue())
+        self.assertIn("Group permissions: 6 change(s) made", output.getvalue())
+        self.assertEquals(16, authors.permissions.all().count())
+
+        output = StringIO()
+        call_command('sync_permissions', stdout=output)
+        self.assertNotIn("  + ", output.getvalue())
+
+        # users have their permissions checked the same way
+        anon = User.objects.get(pk=settings.ANONYMOUS_USER_ID)
+        check_role_permissions(anon, ('blog.post_list',), anon.get_all_permissions())
+        self.assertEquals(['post_list'], list(anon.user_permissions.values_list('codename', flat=True)))
+
 
     def test_smart_model(self):
         p1 = Post.objects.create(title="First Post", body="First Post body", order=1, tags="first",
@@ -595,13 +1679,86 @@ class TagTestCase(TestCase):
         self.assertEquals("value", get(test_dict, 'key'))
         self.assertEquals("", get(test_dict, 'not_there'))
 
+    def test_approximate_count(self):
+        from smartmin.templatetags.smartmin import approximate_count
+
+        self.assertEquals("999", approximate_count(999))
+        self.assertEquals("1.2K", approximate_count(1234))
+        self.assertEquals("1.2M", approximate_count(1234567))
+        self.assertEquals("1M", approximate_count(999999))
+        self.assertEquals("3M", approximate_count(3000000))
+
     def test_map(self):
         from smartmin.templatetags.smartmin import map
         self.assertEquals("title: First Post id: 1", map("title: %(title)s id: %(id)d", self.post))
         
         
 
+class ImportRollbackTest(TransactionTestCase):
+    """
+    Imports whose transactions are really rolled back, which those of TestCase never are
+    """
+    def setUp(self):
+        self.author = User.objects.create_user('author', 'author@group.com', 'author')
 
+    def test_failed_import_counts(self):
+        from smartmin.csv_imports.models import ImportTask
+        from smartmin.csv_imports.tasks import csv_import
+        import tempfile
+        import os
+
+        temp = tempfile.NamedTemporaryFile(dir='.', suffix='.csv')
+        temp.write('title,body,order,tags\nA,A,1,a\nB,B,2,b\nC,C,x,c\n')
+        temp.flush()
+
+        task = ImportTask.objects.create(csv_file=os.path.basename(temp.name), model_class='blog.models.Post',
+                                         created_by=self.author, modified_by=self.author)
+
+        # flush on every count, so what we counted is written before it is rolled back
+        ImportTask.flush_interval = 0
+        Post.import_batch_size = 1
+        try:
+            self.assertRaises(Exception, csv_import, task)
+        finally:
+            ImportTask.flush_interval = 2
+            Post.import_batch_size = 1000
+            temp.close()
+
+        # our rows were rolled back, and so were our counts for them, but the row which failed still counts
+        self.assertFalse(Post.objects.filter(tags__in=['a', 'b', 'c']))
+
+        task = ImportTask.objects.get(pk=task.pk)
+        self.assertEquals((0, 1, 0), (task.rows_processed, task.rows_failed, task.bytes_read))
+        self.assertTrue(task.import_log.find("Error: Line 4:") > 0)
+
+class PermissionSyncTest(TransactionTestCase):
+    """
+    Permission syncs whose transactions are really rolled back
+    """
+    def test_failed_sync(self):
+        import smartmin.management
+        from smartmin.management import sync_all_permissions
 
-
-
+        authors = Group.objects.get(name="Authors")
+        check_role_permissions(authors, ('blog.post.*',), authors.permissions.all())
+        Permission.objects.filter(codename='post_author').delete()
+
+        def fail(dry_run=False):
+            raise Exception("Anonymous sync failed")
+
+        # a failure part way through rolls back everything synced before it
+        sync_anon_permissions = smartmin.management.sync_anon_permissions
+        smartmin.management.sync_anon_permissions = fail
+        try:
+            self.assertRaises(Exception, sync_all_permissions)
+        finally:
+            smartmin.management.sync_anon_permissions = sync_anon_permissions
+
+        self.assertFalse(Permission.objects.filter(codename='post_author'))
+        self.assertEquals(10, authors.permissions.all().count())
+
+        # otherwise everything is synced together
+        self.assertEquals(["permissions", "group permissions", "anonymous permissions"],
+                          [name for (name, changes, elapsed) in sync_all_permissions()])
+        self.assertTrue(Permission.objects.filter(codename='post_author'))
+        self.assertEquals(16, authors.permissions.all().count())
@@ -35,7 +35,7 @@ class CategoryCRUDL(SmartCRUDL):
 class PostCRUDL(SmartCRUDL):
     model = Post
     actions = ('create', 'read', 'update', 'delete', 'list', 'author',
-               'exclude', 'exclude2', 'readonly', 'readonly2', 'messages', 'csv_import')
+               'exclude', 'exclude2', 'readonly', 'readonly2', 'messages', 'csv_import', 'export')
 
     class List(SmartListView):
         fields = ('title', 'tags', 'created_on', 'created_by')
@@ -51,6 +51,13 @@ class PostCRUDL(SmartCRUDL):
 
             return items
 
+    class Export(SmartCsvView):
+        fields = ('title', 'body', 'order')
+        search_fields = ('title__icontains',)
+        default_order = 'order'
+        background_export = True
+        permission = 'blog.post_list'
+
     class Author(SmartListView):
         fields = ('title', 'tags', 'created_on', 'created_by')
         default_order = ('created_by__username', 'order')
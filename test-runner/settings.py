@@ -140,6 +140,7 @@ INSTALLED_APPS = (
     # 'django.contrib.admindocs',
 
     'smartmin.csv_imports',
+    'smartmin.csv_exports',
 
     'djcelery',
 )
@@ -216,6 +217,9 @@ djcelery.setup_loader()
 
 CELERY_RESULT_BACKEND = 'database'
 
+# we don't have a broker when running tests, so run our tasks inline
+CELERY_ALWAYS_EAGER = True
+
 BROKER_BACKEND = 'redis'
 BROKER_HOST = 'localhost'
 BROKER_PORT = 6379
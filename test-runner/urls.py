@@ -11,6 +11,7 @@ urlpatterns = patterns('',
     url(r'^users/', include('smartmin.users.urls')),
     url(r'^blog/', include('blog.urls')),
     url(r'^csv_imports/', include('smartmin.csv_imports.urls')),
+    url(r'^csv_exports/', include('smartmin.csv_exports.urls')),
 
     # Uncomment the admin/doc line below to enable admin documentation:
     # url(r'^admin/doc/', include('django.contrib.admindocs.urls')),